@@ -1,9 +1,12 @@
+import hashlib
+import json
 import logging
-from deriva.core import DerivaServer, DEFAULT_SESSION_CONFIG
+import os
+import time
 
-from cfde_ap import CONFIG
-from cfde_ap.auth import get_app_token
-from cfde_deriva.registry import Registry
+from cfde_ap import CONFIG, archives, checkpoints, loader, transfer, validation
+from cfde_ap.auth import get_app_token, get_webauthn_user
+from cfde_ap.clients import get_deriva_server, get_registry
 from cfde_deriva.submission import Submission
 
 logger = logging.getLogger(__name__)
@@ -12,8 +15,75 @@ logger = logging.getLogger(__name__)
 DERIVA_INGEST_SUCCESS = 'cfde_registry_dp_status:content-ready'
 
 
+def get_archive_headers_map(globus_ep):
+    # The Header map protects from submitting our https_token to non-Globus URLs. This MUST
+    # match, otherwise the Submission() client will attempt to download the Globus GCS Auth
+    # login page instead. r"https://[^/]*[.]data[.]globus[.]org/.*" will match most GCS HTTP pages,
+    # but if a custom domain is used this MUST be updated to use that instead.
+    https_token = get_app_token(f'https://auth.globus.org/scopes/{globus_ep}/https')
+    return {
+        CONFIG['ALLOWED_GCS_HTTPS_HOSTS']: {"Authorization": f"Bearer {https_token}"}
+    }
+
+
+def _get_dcc_auth_cache_file(servername, dcc_id, userinfo):
+    # Keyed on the user identity and their group attributes, so a change in group
+    # membership never hits a stale entry.
+    attributes = sorted(attr["id"] for attr in userinfo["attributes"])
+    key = json.dumps([servername, dcc_id, userinfo["client"]["id"], attributes])
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return os.path.join(CONFIG["DCC_AUTH_CACHE_DIR"], digest)
+
+
+def validate_dcc_id(servername, dcc_id, userinfo):
+    """Check that a user may submit for a DCC. Successful checks are cached on disk
+    for DCC_AUTH_CACHE_TTL seconds, so the cache is shared by all AP processes on
+    this host. Failed checks are never cached.
+
+    Arguments:
+        servername (str): The name of the DERIVA server.
+                Default None to use DEFAULT_SERVER_NAME.
+        dcc_id (str): The DCC to submit for, e.g. "cfde_registry_dcc:kidsfirst".
+        userinfo (dict): The user's Globus userinfo, from auth.get_userinfo().
+
+    Raises exception if the user is not authorized.
+    """
+    servername = servername or CONFIG["DEFAULT_SERVER_NAME"]
+    cache_file = _get_dcc_auth_cache_file(servername, dcc_id, userinfo)
+    try:
+        if time.time() - os.path.getmtime(cache_file) < CONFIG["DCC_AUTH_CACHE_TTL"]:
+            logger.debug(f"Using cached authorization for {dcc_id}")
+            return
+    except FileNotFoundError:
+        pass
+
+    get_registry(servername).validate_dcc_id(dcc_id, get_webauthn_user(userinfo))
+
+    os.makedirs(CONFIG["DCC_AUTH_CACHE_DIR"], exist_ok=True)
+    # Write and rename so concurrent readers never see a partial entry
+    tmp_file = f"{cache_file}.{os.getpid()}"
+    with open(tmp_file, "w"):
+        pass
+    os.replace(tmp_file, cache_file)
+
+
+def validate_archive(archive_path):
+    """Validate a submission's tables against its datapackage before loading any of
+    them into DERIVA, so invalid submissions fail in seconds.
+
+    Arguments:
+        archive_path (str): The path to the downloaded archive.
+
+    Raises validation.ArchiveValidationError with a summary of all errors found.
+    """
+    logger.info(f"Validating tables in {archive_path}")
+    with archives.open_archive(archive_path) as members:
+        validation.validate_datapackage(members)
+    logger.info("Validation succeeded")
+
+
 def deriva_ingest(servername, archive_url, deriva_webauthn_user,
-                  dcc_id=None, globus_ep=None, action_id=None):
+                  dcc_id=None, globus_ep=None, action_id=None, checkpoint=None, checksum=None):
     """Perform an ingest to DERIVA into a catalog, using the CfdeDataPackage.
 
     Arguments:
@@ -23,40 +93,52 @@ def deriva_ingest(servername, archive_url, deriva_webauthn_user,
                 Default None, to create a new catalog.
         acls (dict): The ACLs to set on the catalog.
                 Default None to use default ACLs.
+        checkpoint (dict): The action's checkpoint. Completed phases are recorded in it,
+                and phases it already records are skipped. Default None.
+        checksum (str): The archive's sha256 checksum given by the submitter, verified
+                against the digest computed while the archive is read. Default None.
 
     Returns:
         dict: The result of the ingest.
             success (bool): True when the ingest was successful.
             catalog_id (str): The catalog's ID.
     """
-    credential = {
-        "bearer-token": get_app_token(CONFIG["DEPENDENT_SCOPES"]["deriva_all"])
-    }
-    session_config = DEFAULT_SESSION_CONFIG.copy()
-    session_config["allow_retry_on_all_methods"] = True
-    registry = Registry('https', servername, credentials=credential, session_config=session_config)
-    server = DerivaServer('https', servername, credential, session_config=session_config)
+    registry = get_registry(servername)
+    server = get_deriva_server(servername)
 
     # the Globus action_id is used as the Submission id, this allows us to track submissions
     # in Deriva back to an action.
     submission_id = action_id
     logger.info(f'Submitting new dataset into Deriva using submission id {submission_id}')
 
-    # pre-flight check like action provider might want to do?
-    # this is optional, implicitly happening again in Submission(...)
-    registry.validate_dcc_id(dcc_id, deriva_webauthn_user)
+    # The DCC pre-flight check is done synchronously in /run (see validate_dcc_id()),
+    # and Submission(...) checks again below
 
-    # The Header map protects from submitting our https_token to non-Globus URLs. This MUST
-    # match, otherwise the Submission() client will attempt to download the Globus GCS Auth
-    # login page instead. r"https://[^/]*[.]data[.]globus[.]org/.*" will match most GCS HTTP pages,
-    # but if a custom domain is used this MUST be updated to use that instead.
-    https_token = get_app_token(f'https://auth.globus.org/scopes/{globus_ep}/https')
-    header_map = {
-        CONFIG['ALLOWED_GCS_HTTPS_HOSTS']: {"Authorization": f"Bearer {https_token}"}
-    }
-    submission = Submission(server, registry, submission_id, dcc_id, archive_url,
-                            deriva_webauthn_user, archive_headers_map=header_map)
-    submission.ingest()
+    header_map = get_archive_headers_map(globus_ep)
+    # Serve the archive from local storage or the local cache, so retries skip the
+    # download. A checksum can only be verified on an archive read here.
+    # The digest recorded before the archive was moved finds it again by content
+    archive_digest = (checkpoints.get_phase(checkpoint, "downloaded") or {}).get("archive_digest")
+    if (CONFIG["ARCHIVE_CACHE_MAX_BYTES"] or transfer.get_local_path(archive_url)
+            or checksum):
+        archive_path, archive_digest = archives.fetch_archive(archive_url, header_map,
+                                                              checksum=checksum,
+                                                              digest=archive_digest,
+                                                              pin=action_id)
+        checkpoints.record_phase(checkpoint, "downloaded", {"archive_digest": archive_digest})
+        archive_url = f"file://{archive_path}"
+        if (CONFIG["COLUMNAR_VALIDATION"]
+                and checkpoints.get_phase(checkpoint, "validated") is None):
+            validate_archive(archive_path)
+            checkpoints.record_phase(checkpoint, "validated")
+    if checkpoints.get_phase(checkpoint, "ingested") is None:
+        with loader.parallel_load(servername, checkpoint=checkpoint):
+            submission = Submission(server, registry, submission_id, dcc_id, archive_url,
+                                    deriva_webauthn_user, archive_headers_map=header_map)
+            submission.ingest()
+        checkpoints.record_phase(checkpoint, "ingested")
+    else:
+        logger.info(f"Submission {submission_id} was already ingested, skipping")
 
     md = registry.get_datapackage(submission_id)
     success = md["status"] == DERIVA_INGEST_SUCCESS
@@ -69,5 +151,8 @@ def deriva_ingest(servername, archive_url, deriva_webauthn_user,
         "error": md.get('diagnostics') or False,
         "message": "DERIVA ingest successful" if success else "",
         "submission_id": submission_id,
-        "submission_link": md["review_browse_url"]
+        "submission_link": md["review_browse_url"],
+        "dcc_id": dcc_id,
+        "archive_digest": archive_digest,
+        "checksum_verified": bool(checksum)
     }
@@ -1,8 +1,8 @@
 from datetime import datetime, timedelta, timezone
 import logging.config
-import multiprocessing
+import time
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response
 from globus_action_provider_tools.authentication import TokenChecker
 from globus_action_provider_tools.validation import (
     request_validator,
@@ -11,12 +11,13 @@ from globus_action_provider_tools.validation import (
 from isodate import duration_isoformat, parse_duration, parse_datetime
 import jsonschema
 from openapi_core.wrappers.flask import FlaskOpenAPIResponse, FlaskOpenAPIRequest
-from cfde_deriva.registry import Registry
+from cfde_deriva.exception import Forbidden
 from cfde_deriva.submission import Submission
 
 import cfde_ap.auth
 from cfde_ap import CONFIG
-from . import actions, error as err, utils, transfer
+from . import (actions, archives, callbacks, checkpoints, clients, error as err, logs, queues,
+               scheduler, utils, transfer)
 
 
 # Flask setup
@@ -33,11 +34,12 @@ logger.info("\n\n==========CFDE Action Provider started==========\n")
 # Globals specific to this instance
 TBL = CONFIG["DYNAMO_TABLE"]
 ROOT = "/"  # Segregate different APs by root path?
+# Routes outside the Action Provider OpenAPI spec, which are not spec-validated
+UNSPECCED_ENDPOINTS = {"action_log"}
 TOKEN_CHECKER = TokenChecker(CONFIG["GLOBUS_CC_APP"], CONFIG["GLOBUS_SECRET"],
                              [CONFIG["GLOBUS_SCOPE"]], CONFIG["GLOBUS_AUD"])
 
-# Clean up environment
-utils.clean_environment()
+# DATA_DIR belongs to the ingest worker, which cleans it on startup
 utils.initialize_dmo_table(CONFIG["DYNAMO_TABLE"])
 
 #######################################
@@ -57,10 +59,11 @@ def before_request():
     # Service alive check can skip validation
     if request.path == "/ping":
         return {"success": True}
-    wrapped_req = FlaskOpenAPIRequest(request)
-    validation_result = request_validator.validate(wrapped_req)
-    if validation_result.errors:
-        raise err.InvalidRequest("; ".join([str(err) for err in validation_result.errors]))
+    if request.endpoint not in UNSPECCED_ENDPOINTS:
+        wrapped_req = FlaskOpenAPIRequest(request)
+        validation_result = request_validator.validate(wrapped_req)
+        if validation_result.errors:
+            raise err.InvalidRequest("; ".join([str(err) for err in validation_result.errors]))
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
     auth_state = TOKEN_CHECKER.check_token(token)
     if not auth_state.identities:
@@ -71,6 +74,9 @@ def before_request():
 
 @app.after_request
 def after_request(response):
+    # Not Modified responses have no body to validate
+    if request.endpoint in UNSPECCED_ENDPOINTS or response.status_code == 304:
+        return response
     wrapped_req = FlaskOpenAPIRequest(request)
     wrapped_resp = FlaskOpenAPIResponse(response)
     validation_result = response_validator.validate(wrapped_req, wrapped_resp)
@@ -101,7 +107,7 @@ def meta():
         # "administered_by": [],
         # "admin_contact": "",
         "synchronous": False,
-        "log_supported": False,
+        "log_supported": True,
         # "maximum_deadline": "",
         "input_schema": CONFIG["INPUT_SCHEMA"],
         # "event_types": [],  # Event-type providers only
@@ -114,6 +120,8 @@ def meta():
 
 @app.route(ROOT+"run", methods=["POST"])
 def run():
+    # SYNC_TIME_BUDGET covers the whole request, not only the wait for the ingest
+    run_started = time.monotonic()
     req = request.get_json(force=True)
     # Validate input
     body = req.get("body", {})
@@ -126,11 +134,30 @@ def run():
     # Must have data_url if ingest or restore
     if body["operation"] in ["ingest", "restore"] and not body.get("data_url"):
         raise err.InvalidRequest("You must provide a data_url to ingest or restore.")
+    if body["operation"] == "ingest" and not body.get("dcc_id"):
+        raise err.InvalidRequest("You must provide a dcc_id to ingest.")
+    if body.get("data_url"):
+        transfer.check_url_path(body["data_url"])
+    if body["operation"] == "ingest":
+        transfer.check_submission_path(body["data_url"])
+    if bool(body.get("source_endpoint_id")) != bool(body.get("source_path")):
+        raise err.InvalidRequest("source_endpoint_id and source_path must be given together.")
+    try:
+        callbacks.validate_targets(body.get("callbacks", []))
+    except ValueError as e:
+        raise err.InvalidRequest(str(e))
     # If request_id has been submitted before, return status instead of starting new
     try:
         status = utils.read_action_by_request(TBL, req["request_id"])
     # Otherwise, create new action
     except err.NotFound:
+        # Reject unauthorized submissions before any action is created
+        if body["operation"] == "ingest":
+            try:
+                actions.validate_dcc_id(body.get("server"), body["dcc_id"],
+                                        cfde_ap.auth.get_userinfo())
+            except Forbidden as e:
+                raise err.NotAuthorized(str(e))
         # TODO: Accurately estimate completion time
         estimated_completion = datetime.now(tz=timezone.utc) + timedelta(days=1)
 
@@ -177,10 +204,16 @@ def run():
         job = utils.create_action_status(TBL, job)
 
         # start_action() blocks, throws exception on failure, returns on success
-        start_action(job["action_id"], req["body"])
+        if start_action(job["action_id"], req["body"]):
+            # The ingest is expected to finish within the budget, so wait to return
+            # its final status directly and spare the caller a polling round
+            job = wait_for_status(job["action_id"], job,
+                                  CONFIG["SYNC_TIME_BUDGET"] - (time.monotonic() - run_started),
+                                  lambda s: s["status"] == "ACTIVE")
 
         res = jsonify(utils.translate_status(job))
-        res.status_code = 202
+        # 202 while the action is still running, 200 once it has already completed
+        res.status_code = 200 if job["status"] in ("SUCCEEDED", "FAILED") else 202
         return res
     else:
         return jsonify(utils.translate_status(status))
@@ -191,27 +224,50 @@ def status(action_id):
     status = utils.read_action_status(TBL, action_id)
     if not request.auth.check_authorization(status["monitor_by"]):
         raise err.NotAuthorized("You cannot view the status of action {}".format(action_id))
-    # Check deadline
-    started = datetime.fromisoformat(status["date_started"])
-    time_allotted = timedelta(seconds=CONFIG["INGEST_DEADLINE"])
-    deadline = started + time_allotted
-    timed_out = datetime.now(tz=timezone.utc) > deadline
-    if timed_out:
+    try:
+        wait = min(float(request.args.get("wait", 0)), CONFIG["STATUS_MAX_WAIT"])
+    except ValueError:
+        raise err.InvalidRequest("wait must be a number of seconds")
+    # With wait, hold the request while the caller already has the current status
+    status = wait_for_status(action_id, status, wait,
+                             lambda s: (request.if_none_match.contains(utils.get_status_etag(s))
+                                        and not is_timed_out(s)))
+
+    etag = utils.get_status_etag(status)
+    if is_timed_out(status):
         logger.warning(f"Action {action_id} timed out for unknown reason!")
+        etag += "-timeout"
         status["status"] = "FAILED"
         status["details"]["message"] = ("Submission timed out before it could complete. "
                                         "Check with your administrator for more details")
         try:
-            credential = {
-                "bearer-token": cfde_ap.auth.get_app_token(CONFIG["DEPENDENT_SCOPES"]["deriva_all"])
-            }
-            registry = Registry('https', CONFIG["DEFAULT_SERVER_NAME"], credentials=credential)
+            registry = clients.get_registry(CONFIG["DEFAULT_SERVER_NAME"])
             Submission.report_external_ops_error(registry, action_id,
                                                  "Submission failed to ingest (timeout)")
         except Exception as e:
             # Something terrible happened when registering an error with Deriva
             logger.exception(e)
-    return jsonify(utils.translate_status(status))
+    if request.if_none_match.contains(etag):
+        res = Response(status=304)
+    else:
+        res = jsonify(utils.translate_status(status))
+    res.set_etag(etag)
+    return res
+
+
+@app.route(ROOT+"<action_id>/log", methods=["GET"])
+def action_log(action_id):
+    status = utils.read_action_status(TBL, action_id)
+    if not request.auth.check_authorization(status["monitor_by"]):
+        raise err.NotAuthorized("You cannot view the log of action {}".format(action_id))
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = int(request.args.get("limit", CONFIG["ACTION_LOG_PAGE_SIZE"]))
+    except ValueError:
+        raise err.InvalidRequest("offset and limit must be integers")
+    page = logs.read_action_log(action_id, offset=offset, limit=limit)
+    page["action_id"] = action_id
+    return jsonify(page)
 
 
 @app.route(ROOT+"<action_id>/cancel", methods=["POST"])
@@ -240,6 +296,8 @@ def release(action_id):
         raise err.InvalidState("Action {} not completed and cannot be released".format(action_id))
 
     utils.delete_action_status(TBL, action_id)
+    logs.delete_action_log(action_id)
+    checkpoints.delete_checkpoint(action_id)
     return clean_status
 
 
@@ -247,7 +305,48 @@ def release(action_id):
 # Synchronous events
 #######################################
 
+def wait_for_status(action_id, status, timeout, is_waiting):
+    """Re-read an action's status at growing intervals while is_waiting(status) is
+    True, for up to timeout seconds. Returns the last status read."""
+    wait_until = time.monotonic() + timeout
+    poll_interval = CONFIG["STATUS_WAIT_POLL_INTERVAL"]
+    while is_waiting(status) and time.monotonic() < wait_until:
+        time.sleep(min(poll_interval, max(wait_until - time.monotonic(), 0)))
+        poll_interval = min(poll_interval * 2, CONFIG["STATUS_WAIT_MAX_POLL_INTERVAL"])
+        status = utils.read_action_status(TBL, action_id)
+    return status
+
+
+def is_timed_out(status):
+    """Return True if an active action has run past its deadline, INGEST_DEADLINE
+    after it started unless the action set its own."""
+    if status.get("ingest_deadline"):
+        deadline = datetime.fromisoformat(status["ingest_deadline"])
+    else:
+        started = datetime.fromisoformat(status["date_started"])
+        deadline = started + timedelta(seconds=CONFIG["INGEST_DEADLINE"])
+    return status["status"] == "ACTIVE" and datetime.now(tz=timezone.utc) > deadline
+
+
+def is_known_duplicate(action_data):
+    """Return True if an ingest's checksum matches an archive the DCC already
+    ingested successfully. The ingest then only verifies the archive and reports the
+    earlier submission, with no DERIVA load."""
+    if (not action_data.get("checksum") or action_data.get("force_ingest")
+            or not CONFIG["ARCHIVE_CACHE_MAX_BYTES"]):
+        return False
+    try:
+        utils.read_action_by_digest(TBL, action_data["dcc_id"],
+                                    archives.get_checksum_digest(action_data["checksum"]))
+    except err.NotFound:
+        return False
+    return True
+
+
 def start_action(action_id, action_data):
+    """Start an action. Returns True if the action is likely to finish within
+    SYNC_TIME_BUDGET, so is worth waiting for. Only small ingests of an archive the
+    DCC already ingested are, a DERIVA load takes longer than the budget."""
     # Process keyword catalog ID
     if action_data.get("catalog_id") in CONFIG["KNOWN_CATALOGS"].keys():
         catalog_info = CONFIG["KNOWN_CATALOGS"][action_data["catalog_id"]]
@@ -263,57 +362,66 @@ def start_action(action_id, action_data):
     elif action_data["operation"] == "ingest":
         logger.info(f"{action_id}: Starting Deriva ingest into "
                     f"{action_data.get('catalog_id', 'new catalog')}")
-        # Spawn new process
-        deriva_webauthn_user = cfde_ap.auth.get_webauthn_user()
-        args = (action_id, action_data["data_url"], deriva_webauthn_user, action_data.get("globus_ep"),
-                action_data.get("server"), action_data.get("dcc_id"))
-        driver = multiprocessing.Process(target=action_ingest, args=args, name=action_id)
-        driver.start()
+        # Arguments must be JSON-serializable, they are saved in the ingest checkpoint
+        args = {
+            "url": action_data["data_url"],
+            "userinfo": cfde_ap.auth.get_minimal_userinfo(),
+            "globus_ep": action_data.get("globus_ep"),
+            "servername": action_data.get("server"),
+            "dcc_id": action_data.get("dcc_id"),
+            "force_ingest": action_data.get("force_ingest", False),
+            "callback_targets": action_data.get("callbacks", []),
+            "checksum": action_data.get("checksum"),
+            "source_endpoint_id": action_data.get("source_endpoint_id"),
+            "source_path": action_data.get("source_path")
+        }
+        status_update = {
+            "details": {
+                "message": "Queued, waiting for an ingest worker"
+            }
+        }
+        if args["source_endpoint_id"]:
+            # The ingest worker transfers the data to data_url first
+            timeout = CONFIG["TRANSFER_DEADLINE"] + CONFIG["INGEST_DEADLINE"]
+            deadline = datetime.now(tz=timezone.utc) + timedelta(seconds=timeout)
+            status_update["ingest_deadline"] = deadline.isoformat()
+        try:
+            if args["source_endpoint_id"]:
+                archive_size = transfer.get_file_size(args["source_endpoint_id"],
+                                                      args["source_path"])
+            else:
+                archive_size = transfer.get_archive_size(action_data["data_url"])
+        except Exception as e:
+            # The ingest itself reports a missing archive, don't hold it back here.
+            # Its size is unknown, so the scheduler budgets it as large.
+            logger.warning(f"{action_id}: Could not determine archive size: {e}")
+            archive_size = None
+        utils.update_action_status(TBL, action_id, status_update)
+        # The ingest is run by an ingest worker (cfde_ap.worker)
+        queues.get_queue().put(scheduler.new_job(action_id, args, archive_size,
+                                                 dcc_id=action_data.get("dcc_id"),
+                                                 test_sub=action_data.get("test_sub", False),
+                                                 transfer=bool(args["source_endpoint_id"])))
+        return (not args["source_endpoint_id"] and archive_size is not None
+                and 0 < archive_size <= CONFIG["SYNC_INGEST_MAX_BYTES"]
+                and is_known_duplicate(action_data))
     else:
         raise err.InvalidRequest("Operation '{}' unknown".format(action_data["operation"]))
-    return
+    return False
 
 
 def cancel_action(action_id):
-    # This action doesn't implement cancellation,
+    # Only queued ingests can be cancelled. Running ingests are not interrupted,
     # which is valid according to the Automate spec.
-    # This is a stub in case cancellation is implemented later.
+    if queues.get_queue().cancel(action_id):
+        logger.info(f"{action_id}: Cancelled queued ingest")
+        utils.update_action_status(TBL, action_id, {
+            "status": "FAILED",
+            "details": {
+                "submission_id": "",
+                "submission_link": "",
+                "message": "",
+                "error": "Submission was cancelled before it started"
+            }
+        })
     return
-
-
-#######################################
-# Asynchronous actions
-#######################################
-
-
-def action_ingest(action_id, url, deriva_webauthn_user, globus_ep=None, servername=None, dcc_id=None):
-    if not servername:
-        servername = CONFIG["DEFAULT_SERVER_NAME"]
-
-    # The flow can have unexpected failures if any of the keys in "details" below are absent.
-    # They're filled in with blank values to ensure the flow doesn't panic if we run into
-    # unforeseen circumstances.
-    status = {
-        "status": "FAILED",
-        "details": {
-            "submission_id": "",
-            "submission_link": "",
-            "message": "",
-            "error": "Failed due to unknown error"
-        }
-    }
-    try:
-        logger.debug("Moving data to protected location")
-        url = transfer.move_to_protected_location(url, action_id, dcc_id)
-        logger.debug("Ingesting into Deriva")
-        ingest_res = actions.deriva_ingest(servername, url, deriva_webauthn_user,
-                                           dcc_id=dcc_id, globus_ep=globus_ep, action_id=action_id)
-        status["status"] = ingest_res.pop("status")
-        status["details"].update(ingest_res)
-    except Exception as e:
-        logger.exception(e)
-        logger.error("Submission marked as FAILED due to the exception above.")
-        status["status"] = "FAILED"
-        status["details"]["error"] = f"Error ingesting to DERIVA: {str(e)}"
-    finally:
-        utils.update_action_status(TBL, action_id, status)
@@ -0,0 +1,358 @@
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import tarfile
+import threading
+import zipfile
+
+import requests
+
+from cfde_ap import CONFIG, transfer, validation
+
+logger = logging.getLogger(__name__)
+
+# Archives are stored by content digest under "objects/". Files under "keys/" map a
+# source (the archive URL and its HTTP validators) to the digest of its content.
+# Objects are evicted least-recently-used first, and a hit refreshes the object's mtime.
+# Ingests pin the objects they use with a file under "pins/", named
+# <digest>.<action_id>, and pinned objects are never evicted. Objects are added,
+# pinned and evicted under an exclusive lock on "lock", shared by every process.
+# Archives on storage mounted on this host (GCS_LOCAL_MOUNTS) are read in place, and
+# only their digest is cached, keyed by path, size and mtime.
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_archive_headers(url, headers_map):
+    """Return the headers to send with a request for url. headers_map maps URL regexes
+    to headers, and only matching entries are used, so credentials are never sent to
+    non-matching hosts."""
+    headers = {}
+    for pattern, pattern_headers in (headers_map or {}).items():
+        if re.match(pattern, url):
+            headers.update(pattern_headers)
+    return headers
+
+
+def _get_cache_dir(subdir):
+    path = os.path.join(CONFIG["ARCHIVE_CACHE_DIR"], subdir)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextlib.contextmanager
+def _cache_lock():
+    with open(os.path.join(_get_cache_dir(""), "lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _pin(digest, pin):
+    if pin is not None:
+        open(os.path.join(_get_cache_dir("pins"), f"{digest}.{os.path.basename(pin)}"),
+             "w").close()
+
+
+def unpin_archives(pin):
+    """Unpin every archive pinned by fetch_archive() with pin, so they may be evicted."""
+    pins_dir = _get_cache_dir("pins")
+    for entry in os.scandir(pins_dir):
+        if entry.name.split(".", 1)[-1] == os.path.basename(pin):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def _get_source_key(url, headers):
+    """Identify the current version of the archive at url without downloading it."""
+    res = requests.head(url, headers=headers, allow_redirects=True)
+    res.raise_for_status()
+    # Prefer the ETag, which changes whenever the content does. Files are renamed
+    # into protected storage per action, so the URL is only used without an ETag.
+    if res.headers.get("ETag"):
+        source = ["etag", res.headers["ETag"], res.headers.get("Content-Length")]
+    else:
+        source = ["url", url, res.headers.get("Last-Modified"), res.headers.get("Content-Length")]
+    return hashlib.sha256(json.dumps(source).encode()).hexdigest()
+
+
+def _read_key(source_key):
+    try:
+        with open(os.path.join(_get_cache_dir("keys"), source_key)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _touch(digest):
+    """Mark a cached archive as recently used. Returns False if it is not cached."""
+    try:
+        os.utime(os.path.join(_get_cache_dir("objects"), digest))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _lookup(source_key):
+    digest = _read_key(source_key)
+    if digest is None or not _touch(digest):
+        return None
+    return digest
+
+
+class _TeeReader(object):
+    """File-like reader over a stream of chunks, which copies every chunk read into
+    out_file, if given, and hashes it. This lets the archive be read as it downloads."""
+    def __init__(self, chunks, out_file=None):
+        self.chunks = chunks
+        self.out_file = out_file
+        self.sha256 = hashlib.sha256()
+        self.buf = bytearray()
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self.buf) < size:
+            chunk = next(self.chunks, b"")
+            if not chunk:
+                break
+            self.sha256.update(chunk)
+            if self.out_file:
+                self.out_file.write(chunk)
+            self.buf.extend(chunk)
+        if size is None or size < 0:
+            size = len(self.buf)
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        return data
+
+    def drain(self):
+        """Read the rest of the stream, e.g. archive padding a reader did not need."""
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def _validate_members(reader):
+    """Validate each file of a tar archive as it is read from reader. Returns False
+    if the archive is not a tar archive."""
+    try:
+        # "r|*" reads a stream of any tar compression without seeking
+        with tarfile.open(fileobj=reader, mode="r|*") as tar:
+            for member in tar:
+                if member.isfile():
+                    validation.validate_archive_member(member.name, tar.extractfile(member))
+    except tarfile.ReadError:
+        return False
+    return True
+
+
+def _validate_zip(path, name):
+    """Validate each file of a complete zip archive. Zip archives keep their index at
+    the end, so can only be read once complete."""
+    if not zipfile.is_zipfile(path):
+        raise validation.ArchiveValidationError([f"{name} is not a tar or zip archive"])
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            if not info.is_dir():
+                with zf.open(info) as member:
+                    validation.validate_archive_member(info.filename, member)
+
+
+def _hash_local(path):
+    """Hash a local archive, validating it in the same read when STREAMING_VALIDATION
+    is set, as _download() does.
+
+    Returns:
+        str: The sha256 hex digest of the archive.
+    """
+    with open(path, "rb") as f:
+        reader = _TeeReader(iter(functools.partial(f.read, CHUNK_SIZE), b""))
+        streamed = CONFIG["STREAMING_VALIDATION"] and _validate_members(reader)
+        reader.drain()
+    if CONFIG["STREAMING_VALIDATION"] and not streamed:
+        _validate_zip(path, path)
+    return reader.sha256.hexdigest()
+
+
+def _download(url, headers, pin=None):
+    """Stream url into the cache, hashing it on the way in, and pin it with pin. When
+    STREAMING_VALIDATION is set, the archive's files are validated as they arrive,
+    and the download stops at the first invalid file.
+
+    Returns:
+        str: The sha256 hex digest of the archive.
+    """
+    objects_dir = _get_cache_dir("objects")
+    tmp_path = os.path.join(objects_dir, f".download-{os.getpid()}-{threading.get_ident()}")
+    try:
+        with requests.get(url, headers=headers, stream=True) as res:
+            res.raise_for_status()
+            with open(tmp_path, "wb") as f:
+                reader = _TeeReader(res.iter_content(chunk_size=CHUNK_SIZE), f)
+                streamed = CONFIG["STREAMING_VALIDATION"] and _validate_members(reader)
+                reader.drain()
+        if CONFIG["STREAMING_VALIDATION"] and not streamed:
+            _validate_zip(tmp_path, url)
+        digest = reader.sha256.hexdigest()
+        with _cache_lock():
+            os.replace(tmp_path, os.path.join(objects_dir, digest))
+            _pin(digest, pin)
+    finally:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+    return digest
+
+
+def _write_key(source_key, digest):
+    key_path = os.path.join(_get_cache_dir("keys"), source_key)
+    tmp_path = f"{key_path}.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        f.write(digest)
+    os.replace(tmp_path, key_path)
+
+
+def get_cache_size():
+    """Return the bytes used by cached archives."""
+    if not os.path.isdir(CONFIG["ARCHIVE_CACHE_DIR"]):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(_get_cache_dir("objects"))
+               if entry.is_file())
+
+
+def evict_archives(keep=None):
+    """Delete least-recently-used archives until the cache fits in ARCHIVE_CACHE_MAX_BYTES.
+    Pinned archives are never deleted.
+
+    Arguments:
+        keep (str): The digest of an archive which must not be evicted. Default None.
+    """
+    objects_dir = _get_cache_dir("objects")
+    with _cache_lock():
+        pinned = {entry.name.split(".", 1)[0] for entry in os.scandir(_get_cache_dir("pins"))}
+        entries = []
+        for entry in os.scandir(objects_dir):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= CONFIG["ARCHIVE_CACHE_MAX_BYTES"]:
+                break
+            if entry.name == keep or entry.name in pinned:
+                continue
+            try:
+                os.remove(entry.path)
+                logger.debug(f"Evicted archive {entry.name} ({size} bytes) from cache")
+            except FileNotFoundError:
+                pass
+            total -= size
+    # Keys pointing at evicted objects are treated as misses by _lookup()
+
+
+def get_checksum_digest(checksum):
+    """Return the sha256 hex digest named by a checksum given by the submitter, as
+    hex with an optional "sha256:" prefix."""
+    digest = checksum.lower()
+    if digest.startswith("sha256:"):
+        digest = digest[len("sha256:"):]
+    return digest
+
+
+def verify_checksum(digest, checksum):
+    """Raise ArchiveValidationError if an archive's sha256 digest does not match the
+    checksum given by the submitter."""
+    expected = get_checksum_digest(checksum)
+    if digest != expected:
+        raise validation.ArchiveValidationError(
+            [f"Archive sha256 checksum {digest} does not match the checksum submitted, "
+             f"{expected}"])
+
+
+def fetch_archive(url, headers_map=None, checksum=None, digest=None, pin=None):
+    """Return a local copy of the archive at url, downloading it only if it is not
+    on locally mounted storage and the cache does not already hold the current version.
+
+    Arguments:
+        url (str): The HTTPS URL of the archive.
+        headers_map (dict): URL regexes mapped to the headers to send to matching URLs.
+                Default None.
+        checksum (str): The archive's sha256 checksum given by the submitter. The
+                digest computed while downloading is checked against it.
+                Default None to not check.
+        digest (str): The archive's digest, when already known from fetching it at
+                another url, e.g. before it was moved to protected storage. The archive
+                is then found by its digest, not looked up or hashed again by url.
+                Default None.
+        pin (str): An ID, e.g. the action ID, to pin the cached archive with, so it is
+                not evicted while in use. Release it with unpin_archives(pin).
+                Default None to not pin.
+
+    Returns:
+        tuple: (path, digest)
+            path (str): The path to the cached or locally mounted archive.
+            digest (str): The sha256 hex digest of the archive.
+    """
+    local_path = transfer.get_local_path(url)
+    if local_path:
+        stat = os.stat(local_path)
+        source = ["local", local_path, stat.st_size, stat.st_mtime_ns]
+        source_key = hashlib.sha256(json.dumps(source).encode()).hexdigest()
+        if digest is not None:
+            _write_key(source_key, digest)
+        else:
+            digest = _read_key(source_key)
+        if digest is None:
+            logger.info(f"Reading archive {local_path} from local storage")
+            digest = _hash_local(local_path)
+            _write_key(source_key, digest)
+        if checksum:
+            verify_checksum(digest, checksum)
+        return local_path, digest
+
+    headers = get_archive_headers(url, headers_map)
+    source_key = _get_source_key(url, headers)
+    # Pinned under the lock together with the lookup, so it is not evicted in between
+    with _cache_lock():
+        if digest is not None and _touch(digest):
+            _write_key(source_key, digest)
+        else:
+            digest = _lookup(source_key)
+        if digest:
+            _pin(digest, pin)
+    if digest:
+        logger.info(f"Archive cache hit for {url} ({digest})")
+    else:
+        logger.info(f"Archive cache miss for {url}, downloading")
+        digest = _download(url, headers, pin=pin)
+        _write_key(source_key, digest)
+        evict_archives(keep=digest)
+    if checksum:
+        verify_checksum(digest, checksum)
+    return os.path.join(_get_cache_dir("objects"), digest), digest
+
+
+@contextlib.contextmanager
+def open_archive(path):
+    """Open a tar or zip archive for reading its files without extracting them.
+
+    Arguments:
+        path (str): The path to the archive.
+
+    Yields:
+        dict: Each file name in archive order, mapped to a callable which opens that
+                file as a binary file object.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            yield {info.filename: functools.partial(zf.open, info)
+                   for info in zf.infolist() if not info.is_dir()}
+    else:
+        with tarfile.open(path, "r:*") as tar:
+            yield {member.name: functools.partial(tar.extractfile, member)
+                   for member in tar.getmembers() if member.isfile()}
@@ -1,6 +1,8 @@
 import logging
+import os
+import threading
 import globus_sdk
-from flask import request
+from flask import g, request
 from deriva.core.utils.globus_auth_utils import GlobusAuthUtil
 from cfde_deriva.submission import WebauthnUser, WebauthnAttribute
 
@@ -8,26 +10,79 @@ from cfde_ap.config import CONFIG
 
 logger = logging.getLogger(__name__)
 
+# Authorizers are cached per process and per scope. They renew their own tokens
+# shortly before expiry, so callers always receive a valid token.
+_AUTHORIZERS = {}
+_AUTHORIZERS_PID = None
+_AUTHORIZERS_LOCK = threading.Lock()
+
+
+def get_app_authorizer(scope):
+    """Return this process's authorizer for app tokens with scope. It renews its token
+    shortly before expiry whenever it is used, so clients can hold on to it."""
+    global _AUTHORIZERS_PID
+    # Scopes may be given as a set (see DEPENDENT_SCOPES)
+    scope_key = scope if isinstance(scope, str) else " ".join(sorted(scope))
+    with _AUTHORIZERS_LOCK:
+        # Never reuse an authorizer (and its HTTP session) from a parent process
+        if _AUTHORIZERS_PID != os.getpid():
+            _AUTHORIZERS.clear()
+            _AUTHORIZERS_PID = os.getpid()
+        authorizer = _AUTHORIZERS.get(scope_key)
+        if authorizer is None:
+            cc_app = globus_sdk.ConfidentialAppAuthClient(
+                CONFIG["GLOBUS_CC_APP"],
+                CONFIG["GLOBUS_SECRET"],
+            )
+            authorizer = globus_sdk.ClientCredentialsAuthorizer(
+                scopes=scope_key,  # Deriva scope
+                confidential_client=cc_app
+            )
+            _AUTHORIZERS[scope_key] = authorizer
+            logger.debug(f"Retrieved dependent token for scope '{scope_key}'")
+        return authorizer
+
 
 def get_app_token(scope):
-    cc_app = globus_sdk.ConfidentialAppAuthClient(
-        CONFIG["GLOBUS_CC_APP"],
-        CONFIG["GLOBUS_SECRET"],
-    )
-    access_token = globus_sdk.ClientCredentialsAuthorizer(
-        scopes=scope,  # Deriva scope
-        confidential_client=cc_app
-    ).access_token
-    logger.debug(f"Retrieved dependent token for scope '{scope}'")
-    return access_token
-
-
-def get_webauthn_user():
-    gau = GlobusAuthUtil(
-        client_id=CONFIG["GLOBUS_CC_APP"],
-        client_secret=CONFIG["GLOBUS_SECRET"],
-    )
-    new_user_info = gau.get_userinfo_for_token(request.auth.bearer_token)
+    authorizer = get_app_authorizer(scope)
+    # Fetches a new token if the cached one is about to expire
+    authorizer.check_expiration_time()
+    return authorizer.access_token
+
+
+def get_userinfo():
+    """Return the Globus userinfo for the token on the current request. The lookup
+    is done at most once per request."""
+    if "userinfo" not in g:
+        gau = GlobusAuthUtil(
+            client_id=CONFIG["GLOBUS_CC_APP"],
+            client_secret=CONFIG["GLOBUS_SECRET"],
+        )
+        g.userinfo = gau.get_userinfo_for_token(request.auth.bearer_token)
+    return g.userinfo
+
+
+def get_minimal_userinfo(userinfo=None):
+    """Return only the parts of a Globus userinfo which get_webauthn_user() uses, to
+    pass to ingests. Ingest arguments are saved to disk, tokens and the rest of the
+    userinfo must not be."""
+    if userinfo is None:
+        userinfo = get_userinfo()
+    return {
+        "client": {
+            key: userinfo["client"].get(key)
+            for key in ("id", "display_name", "full_name", "email")
+        },
+        "attributes": [
+            {"id": attr["id"], "display_name": attr.get("display_name", "unknown")}
+            for attr in userinfo["attributes"]
+        ]
+    }
+
+
+def get_webauthn_user(new_user_info=None):
+    if new_user_info is None:
+        new_user_info = get_userinfo()
     return WebauthnUser(
             new_user_info['client']['id'],
             new_user_info['client']['display_name'],
@@ -0,0 +1,138 @@
+import fcntl
+import json
+import logging
+import os
+import socket
+import time
+from urllib.parse import urlparse
+
+import requests
+
+from cfde_ap import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Completion callbacks. An action may name callback targets in /run, and its final
+# status is delivered to each of them. A target is an HTTPS URL, which is POSTed the
+# status as JSON, or, when ALLOW_LOCAL_CALLBACKS is set for testing, a file:// path
+# the status is appended to as a JSON line, or a unix:// socket path it is sent to.
+# Every delivery is first written to the outbox in CALLBACK_OUTBOX_DIR, so failed
+# deliveries are retried with exponential backoff, across worker restarts, until
+# CALLBACK_MAX_ATTEMPTS is reached.
+
+
+def validate_targets(targets):
+    """Raise ValueError if any callback target is not allowed."""
+    for target in targets:
+        scheme = urlparse(target).scheme
+        if scheme in ("file", "unix"):
+            if not CONFIG["ALLOW_LOCAL_CALLBACKS"]:
+                raise ValueError(f"Callback target '{target}' is not allowed, "
+                                 f"only https callbacks are supported")
+        elif scheme != "https" or not urlparse(target).netloc:
+            raise ValueError(f"Callback target '{target}' must be an https URL")
+
+
+def _get_outbox_dir():
+    os.makedirs(CONFIG["CALLBACK_OUTBOX_DIR"], exist_ok=True)
+    return CONFIG["CALLBACK_OUTBOX_DIR"]
+
+
+def _send(target, payload):
+    parsed = urlparse(target)
+    body = json.dumps(payload)
+    if parsed.scheme == "https":
+        res = requests.post(target, data=body, timeout=CONFIG["CALLBACK_TIMEOUT"],
+                            headers={"Content-Type": "application/json"})
+        res.raise_for_status()
+    elif parsed.scheme == "file":
+        with open(parsed.path, "a") as f:
+            f.write(body + "\n")
+    elif parsed.scheme == "unix":
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONFIG["CALLBACK_TIMEOUT"])
+            sock.connect(parsed.path)
+            sock.sendall(body.encode("utf-8") + b"\n")
+    else:
+        raise ValueError(f"Unsupported callback target '{target}'")
+
+
+def _deliver(path):
+    """Attempt one outbox delivery if it is due. Deliveries being attempted by another
+    process are skipped."""
+    try:
+        f = open(path, "r+")
+    except FileNotFoundError:
+        return
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        # Delivered and removed by another process since it was opened
+        if os.fstat(f.fileno()).st_nlink == 0:
+            return
+        try:
+            delivery = json.load(f)
+        except ValueError:
+            logger.error(f"Dropping unreadable callback delivery {path}")
+            os.remove(path)
+            return
+        if delivery["next_attempt_at"] > time.time():
+            return
+        try:
+            _send(delivery["target"], delivery["payload"])
+        except Exception as e:
+            delivery["attempts"] += 1
+            if delivery["attempts"] >= CONFIG["CALLBACK_MAX_ATTEMPTS"]:
+                logger.error(f"{delivery['action_id']}: Giving up on callback to "
+                             f"{delivery['target']} after {delivery['attempts']} attempts: {e}")
+                os.remove(path)
+                return
+            delay = min(CONFIG["CALLBACK_RETRY_DELAY"] * 2 ** (delivery["attempts"] - 1),
+                        CONFIG["CALLBACK_MAX_RETRY_DELAY"])
+            delivery["next_attempt_at"] = time.time() + delay
+            logger.warning(f"{delivery['action_id']}: Callback to {delivery['target']} "
+                           f"failed, retrying in {delay} seconds: {e}")
+            f.seek(0)
+            f.truncate()
+            json.dump(delivery, f)
+        else:
+            logger.info(f"{delivery['action_id']}: Delivered status to {delivery['target']}")
+            os.remove(path)
+
+
+def send_callbacks(action_id, targets, status):
+    """Deliver an action's final status to its callback targets. Each delivery is
+    saved to the outbox and attempted right away, and retried by deliver_due() if it
+    fails.
+
+    Arguments:
+        action_id (str): The ID for the action.
+        targets (list of str): The callback targets.
+        status (dict): The translated action status.
+    """
+    paths = []
+    for i, target in enumerate(targets or []):
+        delivery = {
+            "action_id": action_id,
+            "target": target,
+            "payload": status,
+            "attempts": 0,
+            "next_attempt_at": 0
+        }
+        path = os.path.join(_get_outbox_dir(), f"{action_id}-{i}.json")
+        tmp_path = f"{path}.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(delivery, f)
+        os.replace(tmp_path, path)
+        paths.append(path)
+    for path in paths:
+        _deliver(path)
+
+
+def deliver_due():
+    """Retry every outbox delivery whose backoff has passed."""
+    for entry in os.scandir(_get_outbox_dir()):
+        if entry.name.endswith(".json"):
+            _deliver(entry.path)
@@ -0,0 +1,137 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+
+from cfde_ap import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# A checkpoint records the arguments of an ingest and each phase it has completed,
+# so an interrupted or failed ingest can resume from where it stopped. Each phase
+# is recorded with a dict of the data needed to skip it on resume. The phases are
+# "transfer_submitted" and "transferred" when the AP transfers the data itself,
+# "moved", "downloaded", "validated", "loaded:<datapackage>/<table>" for each table
+# loaded by the parallel loader, "ingested", and "failed" once the ingest has failed.
+# Checkpoints of successful ingests are deleted.
+_SAVE_LOCK = threading.Lock()
+
+
+def _get_checkpoint_path(action_id, ext="json"):
+    os.makedirs(CONFIG["CHECKPOINT_DIR"], exist_ok=True)
+    return os.path.join(CONFIG["CHECKPOINT_DIR"], f"{os.path.basename(action_id)}.{ext}")
+
+
+def load_checkpoint(action_id):
+    """Return the checkpoint for an action, or None if the action has none."""
+    try:
+        with open(_get_checkpoint_path(action_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(checkpoint):
+    path = _get_checkpoint_path(checkpoint["action_id"])
+    # Write and rename so an interrupted write never corrupts the checkpoint
+    tmp_path = f"{path}.{os.getpid()}"
+    with _SAVE_LOCK:
+        # Checkpoints hold the submitting user's identity, readable only by the AP
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                       "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, path)
+
+
+def start_checkpoint(action_id, args):
+    """Return the checkpoint for an action, creating it if it does not exist. An
+    existing checkpoint keeps its completed phases.
+
+    Arguments:
+        action_id (str): The ID for the action.
+        args (dict): The JSON-serializable arguments the action was started with.
+
+    Returns:
+        dict: The checkpoint.
+    """
+    checkpoint = load_checkpoint(action_id)
+    if checkpoint is None:
+        checkpoint = {
+            "action_id": action_id,
+            "args": args,
+            "phases": {}
+        }
+        save_checkpoint(checkpoint)
+    return checkpoint
+
+
+def record_phase(checkpoint, phase, data=None):
+    """Mark a phase as completed and save the checkpoint.
+
+    Arguments:
+        checkpoint (dict): The checkpoint to update. May be None, to not checkpoint.
+        phase (str): The completed phase.
+        data (dict): The results of the phase needed to skip it on resume. Default None.
+    """
+    if checkpoint is None:
+        return
+    # Phases may be recorded from several loader threads at once
+    with _SAVE_LOCK:
+        checkpoint["phases"][phase] = data or {}
+    save_checkpoint(checkpoint)
+    logger.debug(f"{checkpoint['action_id']}: Checkpointed phase '{phase}'")
+
+
+def get_phase(checkpoint, phase):
+    """Return the data recorded for a completed phase, or None if it was not completed."""
+    if checkpoint is None:
+        return None
+    return checkpoint["phases"].get(phase)
+
+
+def find_failed_checkpoint(data_url, dcc_id):
+    """Return the checkpoint of a failed action for the same data_url and DCC, whose
+    completed phases a new action can adopt. Returns None if there is none."""
+    for checkpoint in list_checkpoints():
+        if ("failed" in checkpoint["phases"]
+                and checkpoint["args"].get("url") == data_url
+                and checkpoint["args"].get("dcc_id") == dcc_id):
+            return checkpoint
+    return None
+
+
+def list_checkpoints():
+    """Return all saved checkpoints."""
+    checkpoints = []
+    os.makedirs(CONFIG["CHECKPOINT_DIR"], exist_ok=True)
+    for entry in os.scandir(CONFIG["CHECKPOINT_DIR"]):
+        if entry.name.endswith(".json"):
+            checkpoint = load_checkpoint(entry.name[:-len(".json")])
+            if checkpoint is not None:
+                checkpoints.append(checkpoint)
+    return checkpoints
+
+
+def delete_checkpoint(action_id):
+    for ext in ("json", "lock"):
+        try:
+            os.remove(_get_checkpoint_path(action_id, ext))
+        except FileNotFoundError:
+            pass
+
+
+def lock_action(action_id):
+    """Take the exclusive lock for running an action. The lock is held until the
+    returned file is closed or the process exits.
+
+    Returns:
+        file: The locked file, or None if another process holds the lock.
+    """
+    lock_file = open(_get_checkpoint_path(action_id, "lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
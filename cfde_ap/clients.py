@@ -0,0 +1,104 @@
+import logging
+import os
+import threading
+
+import boto3
+from deriva.core import DerivaServer, DEFAULT_SESSION_CONFIG
+from cfde_deriva.registry import Registry
+import globus_sdk
+
+from cfde_ap import CONFIG
+from cfde_ap.auth import get_app_authorizer, get_app_token
+
+logger = logging.getLogger(__name__)
+
+# Clients are pooled per process, keyed by (client type, server name). Each entry
+# remembers the bearer token (or authorizer) it was built with, and is rebuilt when
+# that changes.
+_POOL = {}
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_deriva_session_config():
+    session_config = DEFAULT_SESSION_CONFIG.copy()
+    session_config["allow_retry_on_all_methods"] = True
+    return session_config
+
+
+def get_deriva_credential():
+    return {
+        "bearer-token": get_app_token(CONFIG["DEPENDENT_SCOPES"]["deriva_all"])
+    }
+
+
+def _get_pooled(kind, servername, token, factory):
+    """Return the pooled client for (kind, servername), building a new one with
+    factory() if none exists in this process or the token has changed."""
+    global _POOL_PID
+    with _POOL_LOCK:
+        # Sessions inherited across a fork share sockets with the parent, never reuse them
+        if _POOL_PID != os.getpid():
+            _POOL.clear()
+            _POOL_PID = os.getpid()
+        key = (kind, servername)
+        pooled = _POOL.get(key)
+        if pooled is not None and pooled[0] == token:
+            return pooled[1]
+        if pooled is not None:
+            logger.debug(f"Bearer token rotated, recycling {kind} client for {servername}")
+        client = factory()
+        _POOL[key] = (token, client)
+        return client
+
+
+def get_registry(servername=None):
+    """Return a pooled Registry client for a DERIVA server.
+
+    Arguments:
+        servername (str): The name of the DERIVA server.
+                Default None to use DEFAULT_SERVER_NAME.
+
+    Returns:
+        Registry: The Registry client.
+    """
+    servername = servername or CONFIG["DEFAULT_SERVER_NAME"]
+    credential = get_deriva_credential()
+    return _get_pooled("registry", servername, credential["bearer-token"],
+                       lambda: Registry('https', servername, credentials=credential,
+                                        session_config=get_deriva_session_config()))
+
+
+def get_deriva_server(servername=None):
+    """Return a pooled DerivaServer client.
+
+    Arguments:
+        servername (str): The name of the DERIVA server.
+                Default None to use DEFAULT_SERVER_NAME.
+
+    Returns:
+        DerivaServer: The server client.
+    """
+    servername = servername or CONFIG["DEFAULT_SERVER_NAME"]
+    credential = get_deriva_credential()
+    return _get_pooled("server", servername, credential["bearer-token"],
+                       lambda: DerivaServer('https', servername, credential,
+                                            session_config=get_deriva_session_config()))
+
+
+def get_dynamodb():
+    """Return a pooled DynamoDB resource. Clients are never shared with a parent
+    process, so ingests forked from the forkserver each create their own."""
+    return _get_pooled("dynamodb", "us-east-1", CONFIG["AWS_KEY"],
+                       lambda: boto3.resource('dynamodb',
+                                              aws_access_key_id=CONFIG["AWS_KEY"],
+                                              aws_secret_access_key=CONFIG["AWS_SECRET"],
+                                              region_name="us-east-1"))
+
+
+def get_transfer_client():
+    """Return a pooled TransferClient. Its authorizer renews the transfer token by
+    itself, so the client and its keep-alive HTTP session last the whole process."""
+    authorizer = get_app_authorizer(CONFIG["DEPENDENT_SCOPES"]["transfer"])
+    return _get_pooled("transfer", "transfer.api.globus.org", authorizer,
+                       lambda: globus_sdk.TransferClient(authorizer=authorizer))
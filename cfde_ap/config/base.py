@@ -1,6 +1,8 @@
 import os
 
 
+DATA_DIR = os.path.join(os.path.expanduser("~"), "deriva_data")
+
 BASE_CONFIG = {
     "GLOBUS_NATIVE_APP": "417301b1-5101-456a-8a27-423e71a2ae26",
     "GLOBUS_CC_APP": "21017803-059f-4a9b-b64c-051ab7c1d05d",
@@ -14,14 +16,98 @@ BASE_CONFIG = {
         }
     },
     "LONG_TERM_STORAGE": '/CFDE/public/',
+    # Submitted data must be in this GCS_ENDPOINT directory, which submitters can write
+    "SUBMISSION_DIR": '/CFDE/data/',
+    # GCS_ENDPOINT paths mapped to where that storage is mounted on this host, e.g.
+    # {"/CFDE/": "/mnt/cfde/"}. Mounted archives are moved and read directly.
+    "GCS_LOCAL_MOUNTS": {},
     "GLOBUS_AUD": "cfde_ap_demo",
     "GLOBUS_GROUP": "a437abe3-c9a4-11e9-b441-0efb3ba9a670",
     "ALLOWED_GCS_HTTPS_HOSTS": r"https://[^/]*[.]data[.]globus[.]org/.*",
-    "DATA_DIR": os.path.join(os.path.expanduser("~"), "deriva_data"),
+    "DATA_DIR": DATA_DIR,
+    # Successful DCC authorization checks are cached here, shared by all AP processes
+    "DCC_AUTH_CACHE_DIR": os.path.join(DATA_DIR, "dcc_auth_cache"),
+    "DCC_AUTH_CACHE_TTL": 5 * 60,  # Seconds
+    # Downloaded archives are cached here, and kept when the AP restarts.
+    # Set ARCHIVE_CACHE_MAX_BYTES to 0 to disable the cache.
+    "ARCHIVE_CACHE_DIR": os.path.join(DATA_DIR, "archive_cache"),
+    "ARCHIVE_CACHE_MAX_BYTES": 50 * 1024 ** 3,  # 50 GiB
+    # Validate archive files while the archive downloads, to fail bad submissions early
+    "STREAMING_VALIDATION": True,
+    "VALIDATION_MAX_ERRORS": 20,  # Errors reported per file before giving up on it
+    # Check the datapackage tables against their table schema before loading them
+    "COLUMNAR_VALIDATION": True,
+    "VALIDATION_CHUNK_ROWS": 100000,  # Rows read into memory at a time per table
     "DERIVA_SCHEMA_NAME": "CFDE",
+    # Maximum number of tables loaded concurrently, per DERIVA server name.
+    # With 1, tables are loaded one at a time by cfde_deriva itself.
+    "TABLE_LOAD_WORKERS": {
+        "default": 1
+    },
+    # Transfers run by the AP are checked every TRANSFER_MIN_PING_INTERVAL seconds at
+    # first, doubling up to TRANSFER_PING_INTERVAL, and cancelled at TRANSFER_DEADLINE
+    "TRANSFER_MIN_PING_INTERVAL": 2,  # Seconds
     "TRANSFER_PING_INTERVAL": 60,  # Seconds
     "TRANSFER_DEADLINE": 24 * 60 * 60,  # 1 day, in seconds
     "INGEST_DEADLINE": 60 * 60,  # One hour in seconds
+    # Longest a status request may wait for the status to change, in seconds. Must stay
+    # well under the gunicorn worker timeout.
+    "STATUS_MAX_WAIT": 20,
+    "STATUS_WAIT_POLL_INTERVAL": 0.5,  # Seconds, doubled after each status read
+    "STATUS_WAIT_MAX_POLL_INTERVAL": 4,
+    # /run returns within SYNC_TIME_BUDGET seconds of its start, waiting meanwhile for
+    # ingests of archives up to SYNC_INGEST_MAX_BYTES which repeat an earlier
+    # submission, by checksum, to finish, to return their final status directly.
+    # Must stay well under the gunicorn worker timeout, see
+    # ansible/cfgs/deriva-action-provider.service.
+    "SYNC_INGEST_MAX_BYTES": 10 * 1024 ** 2,
+    "SYNC_TIME_BUDGET": 10,
+    # Per-action logs are kept outside DATA_DIR so they survive AP restarts
+    "ACTION_LOG_DIR": os.path.join(os.path.expanduser("~"), "deriva_action_logs"),
+    "ACTION_LOG_MAX_BYTES": 5 * 1024 * 1024,  # Per log file, two files kept per action
+    "ACTION_LOG_PAGE_SIZE": 100,  # Default number of log lines returned per page
+    "ACTION_LOG_MAX_PAGE_SIZE": 1000,
+    # Ingest checkpoints are also kept outside DATA_DIR, to resume ingests after restarts
+    "CHECKPOINT_DIR": os.path.join(os.path.expanduser("~"), "deriva_checkpoints"),
+    # Ingest admission control. Ingests reserve an estimate of the disk space they use
+    # in DATA_DIR, and wait in a queue if that would exceed INGEST_DISK_BUDGET.
+    "SCHEDULER_DIR": os.path.join(os.path.expanduser("~"), "deriva_scheduler"),
+    # Bytes, including the archive cache. None uses 80% of the size of DATA_DIR's disk
+    "INGEST_DISK_BUDGET": None,
+    "INGEST_DISK_USAGE_FACTOR": 4,  # Disk used by an ingest, as a multiple of archive size
+    "SMALL_INGEST_BYTES": 100 * 1024 ** 2,  # Ingests using less always fit on disk
+    "MAX_CONCURRENT_INGESTS": 4,  # Production ingests running at once
+    "TEST_INGEST_SLOTS": 2,  # Test submissions running at once, on top of the above
+    # Test submissions use the test lane only with an archive of known size up to
+    # TEST_LANE_MAX_BYTES, and, unless None, from a DCC in TEST_LANE_DCCS
+    "TEST_LANE_MAX_BYTES": 100 * 1024 ** 2,
+    "TEST_LANE_DCCS": None,
+    "DCC_WEIGHTS": {},  # dcc_id: relative share of ingest slots, 1 if not listed
+    # Queue handing ingests from the API to ingest workers. "local" for a worker on the
+    # API's host, or "sqs" with "queue_url" (and optionally "test_queue_url") set.
+    "INGEST_QUEUE": {
+        "backend": "local",
+        "visibility_timeout": 5 * 60  # Seconds a claimed SQS job is hidden without heartbeat
+    },
+    # Most seconds between claims when nothing could be claimed. The local queue wakes
+    # the worker at once when a job is queued.
+    "WORKER_POLL_INTERVAL": 5,
+    "WORKER_HEARTBEAT_INTERVAL": 60,  # Seconds
+    "INGEST_START_METHOD": "forkserver",  # multiprocessing start method for ingests
+    # Resource limits for each ingest process. None for no limit.
+    "INGEST_LIMITS": {
+        "memory_bytes": 16 * 1024 ** 3,
+        "cpu_seconds": 4 * 60 * 60,
+        "open_files": 4096
+    },
+    # Completion callback deliveries are kept here until delivered, across restarts
+    "CALLBACK_OUTBOX_DIR": os.path.join(os.path.expanduser("~"), "deriva_callback_outbox"),
+    "CALLBACK_TIMEOUT": 10,  # Seconds
+    "CALLBACK_MAX_ATTEMPTS": 12,
+    "CALLBACK_RETRY_DELAY": 2,  # Seconds before the first retry, doubled for each retry
+    "CALLBACK_MAX_RETRY_DELAY": 60 * 60,
+    # Also allow file:// and unix:// socket callback targets, for testing only
+    "ALLOW_LOCAL_CALLBACKS": False,
     "LOGGING": {
         "version": 1,
         "disable_existing_loggers": False,
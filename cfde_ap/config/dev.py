@@ -1,5 +1,9 @@
 DEV = {
     "DEFAULT_SERVER_NAME": "app-dev.nih-cfde.org",
     "GCS_ENDPOINT": "36530efa-a1e3-45dc-a6e7-9560a8e9ac49",
-    "DYNAMO_TABLE": "dev-ap-actions"
+    "DYNAMO_TABLE": "dev-ap-actions",
+    "TABLE_LOAD_WORKERS": {
+        "app-dev.nih-cfde.org": 4
+    },
+    "ALLOW_LOCAL_CALLBACKS": True
 }
@@ -11,6 +11,16 @@ INPUT_SCHEMA = {
             "format": "uri",
             "description": "The URL or path to the data for DERIVA ingest."
         },
+        "source_endpoint_id": {
+            "type": "string",
+            "description": ("The UUID of a Globus endpoint to transfer the data from, to "
+                            "data_url, before ingesting it. The endpoint must allow the "
+                            "Action Provider to read source_path.")
+        },
+        "source_path": {
+            "type": "string",
+            "description": "The path of the data file on source_endpoint_id."
+        },
         "globus_ep": {
             "type": "string",
             "description": ("The UUID of the Globus endpoint/collection for the data. "
@@ -38,6 +48,39 @@ INPUT_SCHEMA = {
             "description": ("The existing catalog ID to ingest into, or the name of a pre-defined "
                             "catalog (e.g. 'prod'). To create a new catalog, do not specify "
                             "this value. If specified, the catalog must exist.")
+        },
+        "dcc_id": {
+            "type": "string",
+            "description": ("The DCC the data is submitted for, e.g. "
+                            "'cfde_registry_dcc:kidsfirst'. Required to ingest.")
+        },
+        "test_sub": {
+            "type": "boolean",
+            "description": ("True if this is a test submission. Test submissions are "
+                            "scheduled ahead of other submissions."),
+            "default": False
+        },
+        "checksum": {
+            "type": "string",
+            "pattern": "^(sha256:)?[0-9a-fA-F]{64}$",
+            "description": ("The sha256 checksum of the archive at data_url, in hex with an "
+                            "optional 'sha256:' prefix. If given, the ingest fails unless "
+                            "the archive matches it.")
+        },
+        "callbacks": {
+            "type": "array",
+            "items": {
+                "type": "string"
+            },
+            "description": ("HTTPS URLs to POST the final action status to, as JSON, once "
+                            "the action completes. Failed deliveries are retried.")
+        },
+        "force_ingest": {
+            "type": "boolean",
+            "description": ("Ingest the data even if the DCC has already successfully submitted "
+                            "an identical archive. By default, identical archives are not "
+                            "re-ingested and the existing submission is returned instead."),
+            "default": False
         }
     },
     "required": ["operation"]
@@ -0,0 +1,205 @@
+import logging.config
+import time
+
+import cfde_ap.auth
+from cfde_ap import CONFIG
+from . import (actions, archives, callbacks, checkpoints, error as err, limits, logs, scheduler,
+               utils, transfer)
+
+
+# Ingest processes start from a forkserver (see cfde_ap.worker), and import this
+# module after the fork, so it must import everything an ingest needs and nothing
+# more. Nothing here opens connections on import, so every ingest creates its own
+# clients.
+logging.config.dictConfig(CONFIG["LOGGING"])
+logger = logging.getLogger(__name__)
+
+TBL = CONFIG["DYNAMO_TABLE"]
+
+
+def find_duplicate_submission(url, dcc_id, globus_ep, checksum=None, checkpoint=None,
+                              action_id=None):
+    """Return status details referencing a previous successful ingest of an identical
+    archive for the same DCC, or None if there is none. The archive's digest is
+    recorded in the checkpoint, so the archive is found again after it is moved."""
+    # The archive digest comes from the archive cache
+    if not CONFIG["ARCHIVE_CACHE_MAX_BYTES"]:
+        return None
+    downloaded = checkpoints.get_phase(checkpoint, "downloaded") or {}
+    _, digest = archives.fetch_archive(url, actions.get_archive_headers_map(globus_ep),
+                                       checksum=checksum,
+                                       digest=downloaded.get("archive_digest"),
+                                       pin=action_id)
+    checkpoints.record_phase(checkpoint, "downloaded", {"archive_digest": digest})
+    try:
+        previous = utils.read_action_by_digest(TBL, dcc_id, digest)
+    except err.NotFound:
+        return None
+    logger.info(f"Archive {digest} was already ingested by action {previous['action_id']}")
+    return {
+        "submission_id": previous["details"]["submission_id"],
+        "submission_link": previous["details"]["submission_link"],
+        "message": (f"This archive is identical to submission "
+                    f"{previous['details']['submission_id']}, and was not ingested again"),
+        "error": False,
+        "dcc_id": dcc_id,
+        "archive_digest": digest,
+        "checksum_verified": bool(checksum),
+        "duplicate_of": previous["action_id"]
+    }
+
+
+def adopt_failed_checkpoint(checkpoint, url, dcc_id, checksum=None):
+    """Take over the moved archive of a failed action for the same data_url and DCC.
+    The archive at url was moved away by that action, so it is adopted only if url
+    no longer exists. Data uploaded to url again is a new submission, and a moved
+    archive whose digest does not match the checksum submitted is not used."""
+    failed = checkpoints.find_failed_checkpoint(url, dcc_id)
+    if failed is None or checkpoints.get_phase(failed, "moved") is None:
+        return
+    if transfer.file_exists(url):
+        logger.info(f"{url} was uploaded again since failed action "
+                    f"{failed['action_id']}, not resuming from it")
+        return
+    digest = (checkpoints.get_phase(failed, "downloaded") or {}).get("archive_digest")
+    if checksum and digest:
+        try:
+            archives.verify_checksum(digest, checksum)
+        except ValueError:
+            logger.info(f"Archive of failed action {failed['action_id']} does not match "
+                        f"the checksum submitted, not resuming from it")
+            return
+    logger.info(f"Resuming from failed action {failed['action_id']}")
+    checkpoints.record_phase(checkpoint, "moved", checkpoints.get_phase(failed, "moved"))
+    if digest:
+        checkpoints.record_phase(checkpoint, "downloaded", {"archive_digest": digest})
+    checkpoints.delete_checkpoint(failed["action_id"])
+
+
+def transfer_data(action_id, checkpoint, source_endpoint_id, source_path, url):
+    """Transfer the submitted data to url on the GCS endpoint, and wait for it. The
+    transfer is submitted with a Transfer submission ID saved in the checkpoint, so
+    a resumed ingest finds its transfer instead of starting another one."""
+    submitted = checkpoints.get_phase(checkpoint, "transfer_submitted")
+    if submitted is None:
+        submitted = {
+            "submission_id": transfer.get_submission_id(),
+            "deadline": time.time() + CONFIG["TRANSFER_DEADLINE"]
+        }
+        checkpoints.record_phase(checkpoint, "transfer_submitted", submitted)
+    task_id = transfer.submit_transfer(submitted["submission_id"], source_endpoint_id,
+                                       source_path, url, submitted["deadline"])
+    logger.info(f"Transferring {source_endpoint_id}:{source_path} in task {task_id}")
+    utils.update_action_status(TBL, action_id, {
+        "details": {
+            "message": "Transferring data",
+            "transfer_task_id": task_id
+        }
+    })
+    transfer.wait_for_transfer(task_id, submitted["deadline"])
+
+
+def action_ingest(action_id, url, userinfo, globus_ep=None, servername=None,
+                  dcc_id=None, force_ingest=False, callback_targets=None, checksum=None,
+                  source_endpoint_id=None, source_path=None):
+    # Another process may already be running (or resuming) this action
+    lock = checkpoints.lock_action(action_id)
+    if lock is None:
+        logger.info(f"{action_id}: Ingest is already running in another process")
+        return
+    limits.apply_limits()
+    checkpoint = checkpoints.start_checkpoint(action_id, {
+        "url": url,
+        "userinfo": cfde_ap.auth.get_minimal_userinfo(userinfo),
+        "globus_ep": globus_ep,
+        "servername": servername,
+        "dcc_id": dcc_id,
+        "force_ingest": force_ingest,
+        "callback_targets": callback_targets,
+        "checksum": checksum,
+        "source_endpoint_id": source_endpoint_id,
+        "source_path": source_path
+    })
+    if not servername:
+        servername = CONFIG["DEFAULT_SERVER_NAME"]
+    deriva_webauthn_user = cfde_ap.auth.get_webauthn_user(userinfo)
+
+    # The flow can have unexpected failures if any of the keys in "details" below are absent.
+    # They're filled in with blank values to ensure the flow doesn't panic if we run into
+    # unforeseen circumstances.
+    status = {
+        "status": "FAILED",
+        "details": {
+            "submission_id": "",
+            "submission_link": "",
+            "message": "",
+            "error": "Failed due to unknown error"
+        }
+    }
+    log_handler = None
+    try:
+        log_handler = logs.capture_action_log(action_id)
+        if source_endpoint_id and checkpoints.get_phase(checkpoint, "transferred") is None:
+            transfer_data(action_id, checkpoint, source_endpoint_id, source_path, url)
+            checkpoints.record_phase(checkpoint, "transferred")
+        if source_endpoint_id:
+            utils.update_action_status(TBL, action_id, {
+                "details": {
+                    "message": "Transfer complete, waiting for an ingest slot"
+                }
+            })
+        # An ingest which waited on its transfer takes an ingest slot only now
+        scheduler.start_ingest_stage(action_id)
+        if source_endpoint_id:
+            utils.update_action_status(TBL, action_id, {
+                "details": {
+                    "message": "Ingest started"
+                }
+            })
+
+        # A failed ingest of the same data already moved it, the original url is gone
+        if not checkpoint["phases"]:
+            adopt_failed_checkpoint(checkpoint, url, dcc_id, checksum)
+        moved = checkpoints.get_phase(checkpoint, "moved")
+        if moved is not None:
+            url = moved["url"]
+
+        duplicate = None
+        if not force_ingest:
+            duplicate = find_duplicate_submission(url, dcc_id, globus_ep, checksum,
+                                                  checkpoint=checkpoint, action_id=action_id)
+        if duplicate:
+            status["status"] = "SUCCEEDED"
+            status["details"].update(duplicate)
+        else:
+            if moved is None:
+                logger.debug("Moving data to protected location")
+                url = transfer.move_to_protected_location(url, action_id, dcc_id)
+                checkpoints.record_phase(checkpoint, "moved", {"url": url})
+            logger.debug("Ingesting into Deriva")
+            ingest_res = actions.deriva_ingest(servername, url, deriva_webauthn_user,
+                                               dcc_id=dcc_id, globus_ep=globus_ep,
+                                               action_id=action_id, checkpoint=checkpoint,
+                                               checksum=checksum)
+            status["status"] = ingest_res.pop("status")
+            status["details"].update(ingest_res)
+    except Exception as e:
+        logger.exception(e)
+        logger.error("Submission marked as FAILED due to the exception above.")
+        status["status"] = "FAILED"
+        status["details"]["error"] = (limits.describe_limit_error(e)
+                                      or f"Error ingesting to DERIVA: {str(e)}")
+    finally:
+        status["details"]["resources"] = limits.get_usage()
+        logger.info(f"Resources used: {status['details']['resources']}")
+        if status["status"] == "SUCCEEDED":
+            checkpoints.delete_checkpoint(action_id)
+        else:
+            checkpoints.record_phase(checkpoint, "failed")
+        final_status = utils.update_action_status(TBL, action_id, status)
+        archives.unpin_archives(action_id)
+        if log_handler is not None:
+            logs.release_action_log(log_handler)
+        lock.close()
+        callbacks.send_callbacks(action_id, callback_targets,
+                                 utils.translate_status(final_status))
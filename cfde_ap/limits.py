@@ -0,0 +1,83 @@
+from decimal import Decimal
+import logging
+import resource
+import signal
+
+from cfde_ap import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Per-ingest resource limits, set by INGEST_LIMITS and enforced with rlimits on the
+# ingest process, so one pathological submission cannot exhaust the host. Memory is
+# limited through RLIMIT_DATA, which on Linux counts the process's private writable
+# memory and is the closest rlimit to an RSS cap (RLIMIT_RSS is not enforced).
+# The CPU time limit raises ResourceLimitExceeded at the soft limit, and the process
+# is killed at the hard limit CPU_GRACE_SECONDS later if it has not yet finished.
+CPU_GRACE_SECONDS = 60
+
+
+class ResourceLimitExceeded(Exception):
+    """The ingest went over one of its resource limits."""
+
+
+def _on_cpu_limit(signum, frame):
+    raise ResourceLimitExceeded(f"Ingest exceeded its CPU time limit of "
+                                f"{CONFIG['INGEST_LIMITS']['cpu_seconds']} seconds")
+
+
+def apply_limits():
+    """Apply INGEST_LIMITS to this process. Must be called from the main thread,
+    before any work is started. Limits which are None are left unchanged."""
+    limits = CONFIG["INGEST_LIMITS"]
+    if limits.get("memory_bytes"):
+        resource.setrlimit(resource.RLIMIT_DATA,
+                           (limits["memory_bytes"], limits["memory_bytes"]))
+    if limits.get("cpu_seconds"):
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+        resource.setrlimit(resource.RLIMIT_CPU,
+                           (limits["cpu_seconds"], limits["cpu_seconds"] + CPU_GRACE_SECONDS))
+    if limits.get("open_files"):
+        # The soft limit cannot be raised past the hard limit
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        soft = (limits["open_files"] if hard == resource.RLIM_INFINITY
+                else min(limits["open_files"], hard))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def describe_limit_error(e):
+    """Return a message for an exception caused by a resource limit, or None if the
+    exception has another cause."""
+    if isinstance(e, ResourceLimitExceeded):
+        return str(e)
+    if isinstance(e, MemoryError) and CONFIG["INGEST_LIMITS"].get("memory_bytes"):
+        return (f"Ingest exceeded its memory limit of "
+                f"{CONFIG['INGEST_LIMITS']['memory_bytes']} bytes")
+    return None
+
+
+def get_usage():
+    """Return the resources used by this process and its threads so far.
+
+    Returns:
+        dict: The usage, with only DynamoDB-compatible types:
+            peak_rss_bytes (int): The peak resident set size.
+            cpu_seconds (Decimal): The user and system CPU time.
+            read_bytes (int): Bytes read from storage, where known.
+            write_bytes (int): Bytes written to storage, where known.
+    """
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    usage = {
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_bytes": rusage.ru_maxrss * 1024,
+        "cpu_seconds": Decimal(f"{rusage.ru_utime + rusage.ru_stime:.3f}")
+    }
+    try:
+        with open("/proc/self/io") as f:
+            io_counters = dict(line.strip().split(": ") for line in f if ": " in line)
+        usage["read_bytes"] = int(io_counters["read_bytes"])
+        usage["write_bytes"] = int(io_counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        # Not Linux, or no I/O accounting. Block counts are the closest measure.
+        usage["read_bytes"] = rusage.ru_inblock * 512
+        usage["write_bytes"] = rusage.ru_oublock * 512
+    return usage
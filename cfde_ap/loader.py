@@ -0,0 +1,154 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextlib
+import inspect
+import json
+import logging
+import os
+
+import cfde_deriva
+import cfde_deriva.submission
+from cfde_deriva.datapackage import CfdeDataPackage
+
+from cfde_ap import CONFIG, checkpoints
+
+logger = logging.getLogger(__name__)
+
+# The parallel loader runs cfde_deriva's own load_data_files() once per table, each
+# call given a progress dict in which every other table is already loaded. Value
+# conversion, onconflict handling and the table callbacks are all cfde_deriva's,
+# only the order and concurrency of the table loads change.
+_CFDE_DERIVA_DIR = os.path.dirname(os.path.abspath(cfde_deriva.__file__))
+
+
+def get_table_dependencies(datapackage):
+    """Return the tables each table references through foreign keys.
+
+    Arguments:
+        datapackage (dict): The Frictionless datapackage definition.
+
+    Returns:
+        dict: Each table name mapped to the set of table names it depends on.
+                Self-references and references to tables outside the datapackage
+                are ignored, as they do not affect load order.
+    """
+    names = {resource["name"] for resource in datapackage["resources"]}
+    dependencies = {}
+    for resource in datapackage["resources"]:
+        depends_on = set()
+        for fkey in resource.get("schema", {}).get("foreignKeys", []):
+            referenced = fkey["reference"].get("resource") or resource["name"]
+            if referenced in names and referenced != resource["name"]:
+                depends_on.add(referenced)
+        dependencies[resource["name"]] = depends_on
+    return dependencies
+
+
+def get_table_load_workers(servername):
+    return CONFIG["TABLE_LOAD_WORKERS"].get(servername, CONFIG["TABLE_LOAD_WORKERS"]["default"])
+
+
+class ParallelDataPackage(CfdeDataPackage):
+    """A CfdeDataPackage whose load_data_files() loads up to max_workers tables at
+    once, each as soon as every table it references has loaded. Only submitted
+    datapackages are loaded in parallel, the datapackages built into cfde_deriva
+    are loaded as usual. Set up by parallel_load()."""
+    max_workers = 1
+    checkpoint = None
+
+    def __init__(self, package_filename, *args, **kwargs):
+        super().__init__(package_filename, *args, **kwargs)
+        self._package_filename = package_filename
+
+    def _is_submitted(self):
+        if not isinstance(self._package_filename, str):
+            return False
+        path = os.path.abspath(self._package_filename)
+        return os.path.commonpath([path, _CFDE_DERIVA_DIR]) != _CFDE_DERIVA_DIR
+
+    def load_data_files(self, *args, **kwargs):
+        load = super().load_data_files
+        signature = inspect.signature(load)
+        if (self.max_workers <= 1 or not self._is_submitted()
+                or "progress" not in signature.parameters):
+            return load(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+
+        with open(self._package_filename) as f:
+            datapackage = json.load(f)
+        # Phases are named per datapackage, so tables of different packages never clash
+        package_name = datapackage.get("name") or os.path.basename(self._package_filename)
+        progress = bound.arguments.get("progress")
+        if progress is None:
+            progress = {}
+        pending = get_table_dependencies(datapackage)
+        names = set(pending)
+        done = set()
+        for name in names:
+            if (progress.get(name) or checkpoints.get_phase(
+                    self.checkpoint, f"loaded:{package_name}/{name}") is not None):
+                progress[name] = True
+                done.add(name)
+                pending.pop(name)
+
+        def load_one(name):
+            failed = []
+            table_bound = signature.bind(*bound.args, **bound.kwargs)
+            # Every other table is marked loaded, so this call loads only this table
+            table_bound.arguments["progress"] = {other: True for other in names - {name}}
+            error_callback = table_bound.arguments.get("table_error_callback")
+            if "table_error_callback" in signature.parameters:
+                def on_error(*callback_args, **callback_kwargs):
+                    failed.append(callback_args)
+                    if error_callback is not None:
+                        error_callback(*callback_args, **callback_kwargs)
+                table_bound.arguments["table_error_callback"] = on_error
+            load(*table_bound.args, **table_bound.kwargs)
+            if failed:
+                raise RuntimeError(f"Table {name} failed to load")
+
+        logger.info(f"Loading {package_name} with {self.max_workers} concurrent table loads")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while pending or running:
+                for name, depends_on in list(pending.items()):
+                    if depends_on <= done:
+                        logger.debug(f"Loading table {name}")
+                        running[executor.submit(load_one, name)] = name
+                        pending.pop(name)
+                if not running:
+                    raise ValueError(f"Tables {sorted(pending)} have circular foreign keys")
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    # Raises the table's load error, after which the executor waits
+                    # for the running loads and nothing new is started
+                    future.result()
+                    progress[name] = True
+                    checkpoints.record_phase(self.checkpoint, f"loaded:{package_name}/{name}")
+                    done.add(name)
+
+
+@contextlib.contextmanager
+def parallel_load(servername, checkpoint=None):
+    """Load the tables of datapackages submitted by Submission in parallel, within
+    this block. Submission builds its datapackages itself, so ParallelDataPackage is
+    put in its place for the duration. Does nothing for servers configured for one
+    table load at a time.
+
+    Arguments:
+        servername (str): The name of the DERIVA server being loaded.
+        checkpoint (dict): The action's checkpoint. Each loaded table is recorded, and
+                tables already recorded are skipped. Default None.
+    """
+    max_workers = get_table_load_workers(servername)
+    original = getattr(cfde_deriva.submission, "CfdeDataPackage", None)
+    if max_workers <= 1 or original is not CfdeDataPackage:
+        yield
+        return
+    package_class = type("ParallelDataPackage", (ParallelDataPackage,),
+                         {"max_workers": max_workers, "checkpoint": checkpoint})
+    cfde_deriva.submission.CfdeDataPackage = package_class
+    try:
+        yield
+    finally:
+        cfde_deriva.submission.CfdeDataPackage = original
@@ -0,0 +1,186 @@
+from itertools import islice
+import logging
+import logging.handlers
+import os
+
+from cfde_ap import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Loggers whose records are captured into the per-action log
+CAPTURED_LOGGERS = ("cfde_ap", "cfde_deriva", "bdbag")
+# Each log file starts with this header and the number of its first line in the
+# action's log, so lines keep their number when the log rotates
+FIRST_LINE_HEADER = "#first_line "
+
+
+def get_action_log_paths(action_id):
+    """Return the log files for an action, oldest first. The first file is the
+    rotated backup and may not exist.
+
+    Arguments:
+        action_id (str): The ID for the action.
+
+    Returns:
+        list: The paths to the action's log files.
+    """
+    # Action IDs are UUIDs, basename() keeps a malformed ID from escaping the log dir
+    log_file = os.path.join(CONFIG["ACTION_LOG_DIR"], f"{os.path.basename(action_id)}.log")
+    return [f"{log_file}.1", log_file]
+
+
+def _open_log_file(path):
+    """Open one of an action's log files for reading.
+
+    Returns:
+        tuple: (file, first_line)
+            file: The file, positioned after its header, or None if it does not exist.
+            first_line (int): The number of the file's first line in the action's log,
+                    or None for a file without a header.
+    """
+    try:
+        f = open(path)
+    except FileNotFoundError:
+        return None, None
+    header = f.readline()
+    if header.startswith(FIRST_LINE_HEADER):
+        return f, int(header[len(FIRST_LINE_HEADER):])
+    f.seek(0)
+    return f, None
+
+
+def _get_next_line(path):
+    """Return the number in the action's log of the line after the last one in path."""
+    f, first_line = _open_log_file(path)
+    if f is None:
+        return 0
+    with f:
+        return (first_line or 0) + sum(1 for _ in f)
+
+
+class _ActionLogHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler which writes FIRST_LINE_HEADER at the start of each file."""
+    def __init__(self, filename, **kwargs):
+        # A resumed ingest appends to the action's existing log
+        self.first_line = _get_next_line(filename)
+        super().__init__(filename, **kwargs)
+
+    def _open(self):
+        stream = super()._open()
+        if stream.tell() == 0:
+            stream.write(f"{FIRST_LINE_HEADER}{self.first_line}\n")
+            stream.flush()
+        return stream
+
+    def doRollover(self):
+        self.first_line = _get_next_line(self.baseFilename)
+        super().doRollover()
+
+
+def capture_action_log(action_id):
+    """Start capturing log records from this process into the action's log. The log
+    is bounded: once a file reaches ACTION_LOG_MAX_BYTES it is rotated, and only the
+    newest rotation is kept. Lines are numbered from the start of the action's log,
+    and keep their number across rotations.
+
+    Arguments:
+        action_id (str): The ID for the action.
+
+    Returns:
+        logging.Handler: The capturing handler, to be passed to release_action_log().
+    """
+    os.makedirs(CONFIG["ACTION_LOG_DIR"], exist_ok=True)
+    handler = _ActionLogHandler(get_action_log_paths(action_id)[-1],
+                                maxBytes=CONFIG["ACTION_LOG_MAX_BYTES"], backupCount=1)
+    handler.setLevel(logging.DEBUG)
+    # The dictConfig formatter keys differ from Formatter's argument names
+    formatter_config = CONFIG["LOGGING"]["formatters"]["basic"]
+    handler.setFormatter(logging.Formatter(fmt=formatter_config.get("format"),
+                                           datefmt=formatter_config.get("datefmt"),
+                                           style=formatter_config.get("style", "%")))
+    for name in CAPTURED_LOGGERS:
+        logging.getLogger(name).addHandler(handler)
+    return handler
+
+
+def release_action_log(handler):
+    """Stop capturing log records started with capture_action_log()."""
+    for name in CAPTURED_LOGGERS:
+        logging.getLogger(name).removeHandler(handler)
+    handler.close()
+
+
+def read_action_log(action_id, offset=0, limit=None):
+    """Read one page of an action's log. Files are read line by line, so only the
+    requested page is held in memory.
+
+    Arguments:
+        action_id (str): The ID for the action.
+        offset (int): The number of the first line to return, counted from the start
+                of the action's log. Numbers do not change when the log rotates, so
+                a client can poll with the offset after the last line it read.
+                Default 0.
+        limit (int): The maximum number of lines to return.
+                Default None to use ACTION_LOG_PAGE_SIZE.
+
+    Returns:
+        dict: The page of the log.
+            entries (list of str): The log lines.
+            offset (int): The number of the first returned line. It is past the
+                    offset requested when those lines were already rotated away.
+            has_next_page (bool): True when more lines exist after this page.
+    """
+    if limit is None:
+        limit = CONFIG["ACTION_LOG_PAGE_SIZE"]
+    limit = max(0, min(limit, CONFIG["ACTION_LOG_MAX_PAGE_SIZE"]))
+    offset = max(0, offset)
+
+    backup_path, log_path = get_action_log_paths(action_id)
+    # The newest file is opened first. If the log rotates before the backup is
+    # opened, the backup is the same file, found by its inode, and is skipped.
+    log = _open_log_file(log_path)
+    backup = _open_log_file(backup_path)
+    files = [log]
+    if backup[0] is not None:
+        if log[0] is not None and (os.fstat(backup[0].fileno()).st_ino
+                                   == os.fstat(log[0].fileno()).st_ino):
+            backup[0].close()
+        else:
+            files.insert(0, backup)
+
+    def lines():
+        number = 0
+        for i, (f, first_line) in enumerate(files):
+            if f is None:
+                continue
+            with f:
+                next_first_line = files[i + 1][1] if i + 1 < len(files) else None
+                # Files wholly before the offset are not read
+                if next_first_line is not None and next_first_line <= offset:
+                    continue
+                if first_line is not None:
+                    number = first_line
+                for line in f:
+                    if number >= offset:
+                        yield number, line.rstrip("\n")
+                    number += 1
+
+    # Read one extra line to tell whether another page exists
+    page = list(islice(lines(), limit + 1))
+    for f, _ in files:
+        if f is not None:
+            f.close()
+    return {
+        "entries": [line for _, line in page[:limit]],
+        "offset": page[0][0] if page else offset,
+        "has_next_page": len(page) > limit
+    }
+
+
+def delete_action_log(action_id):
+    """Remove all log files for an action."""
+    for path in get_action_log_paths(action_id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,136 @@
+import json
+import logging
+import socket
+import time
+
+import boto3
+
+from cfde_ap import CONFIG, scheduler, utils
+
+logger = logging.getLogger(__name__)
+
+# Ingest jobs are handed from the API to ingest workers (cfde_ap.worker) through a
+# queue, set by INGEST_QUEUE["backend"]. The "local" backend keeps the queue in
+# SCHEDULER_DIR, for a worker on the same host as the API. The "sqs" backend uses
+# Amazon SQS, for workers on any number of hosts. Every backend has the same
+# methods: put() a job, claim() the next job this host has room for, wait() for
+# new jobs, heartbeat() a running job, mark it done() once finished, and cancel() a
+# job still queued.
+_QUEUE = None
+
+
+class LocalQueue(object):
+    """Queue in SCHEDULER_DIR. Jobs are claimed fairly between DCCs by the scheduler."""
+    def put(self, job):
+        scheduler.enqueue(job)
+
+    def claim(self):
+        return scheduler.claim()
+
+    def wait(self, timeout):
+        scheduler.wait_for_jobs(timeout)
+
+    def heartbeat(self, job):
+        pass
+
+    def done(self, job):
+        scheduler.release(job["action_id"])
+
+    def cancel(self, action_id):
+        return scheduler.cancel(action_id)
+
+
+class SQSQueue(object):
+    """Amazon SQS queues, one for production jobs and optionally one for test jobs.
+    With a FIFO queue, each DCC is a message group, and SQS hands out one job per
+    DCC at a time, which keeps DCCs from starving each other. Claimed messages stay
+    invisible to other workers while heartbeat() is called, and are deleted once done.
+    Checkpoints, action locks and reservations are kept on the host running an
+    ingest, so each action is claimed for one host in DynamoDB. Should its message
+    be received by another host, e.g. after the worker running it was restarted,
+    that host drops it, and the ingest is resumed by the worker on its own host.
+    """
+    def __init__(self, queue_url, test_queue_url=None, visibility_timeout=300):
+        self.client = boto3.client("sqs",
+                                   aws_access_key_id=CONFIG["AWS_KEY"],
+                                   aws_secret_access_key=CONFIG["AWS_SECRET"],
+                                   region_name="us-east-1")
+        self.queue_url = queue_url
+        self.test_queue_url = test_queue_url or queue_url
+        self.visibility_timeout = visibility_timeout
+
+    def put(self, job):
+        queue_url = self.test_queue_url if job["test_sub"] else self.queue_url
+        message = {
+            "QueueUrl": queue_url,
+            "MessageBody": json.dumps(job)
+        }
+        if queue_url.endswith(".fifo"):
+            message["MessageGroupId"] = job["dcc_id"] or "none"
+            message["MessageDeduplicationId"] = job["action_id"]
+        self.client.send_message(**message)
+
+    def claim(self):
+        # Test jobs first, as with the local queue
+        for queue_url in dict.fromkeys([self.test_queue_url, self.queue_url]):
+            res = self.client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=1,
+                                              VisibilityTimeout=self.visibility_timeout)
+            for message in res.get("Messages", []):
+                job = json.loads(message["Body"])
+                job["receipt"] = [queue_url, message["ReceiptHandle"]]
+                if scheduler.reserve(job):
+                    # Claimed only once reserved, so a host without room never holds it
+                    if utils.claim_action_host(CONFIG["DYNAMO_TABLE"], job["action_id"],
+                                               socket.gethostname()):
+                        return job
+                    logger.info(f"{job['action_id']}: Ingest belongs to another host, "
+                                f"dropping its message")
+                    scheduler.release(job["action_id"])
+                    self.client.delete_message(QueueUrl=queue_url,
+                                               ReceiptHandle=message["ReceiptHandle"])
+                    continue
+                # No room on this host, give another worker the chance
+                self.client.change_message_visibility(
+                    QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"],
+                    VisibilityTimeout=0)
+        return None
+
+    def wait(self, timeout):
+        # Jobs may be sent from any host, so the queue is polled
+        time.sleep(timeout)
+
+    def heartbeat(self, job):
+        queue_url, receipt = job["receipt"]
+        try:
+            self.client.change_message_visibility(QueueUrl=queue_url, ReceiptHandle=receipt,
+                                                  VisibilityTimeout=self.visibility_timeout)
+        except Exception as e:
+            logger.warning(f"{job['action_id']}: Could not extend queue message visibility: {e}")
+
+    def done(self, job):
+        scheduler.release(job["action_id"])
+        queue_url, receipt = job["receipt"]
+        try:
+            self.client.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt)
+        except Exception as e:
+            logger.warning(f"{job['action_id']}: Could not delete queue message: {e}")
+
+    def cancel(self, action_id):
+        # Messages cannot be removed from an SQS queue by action. Workers skip jobs
+        # whose action is no longer ACTIVE instead.
+        return False
+
+
+def get_queue():
+    """Return the ingest queue set by INGEST_QUEUE."""
+    global _QUEUE
+    if _QUEUE is None:
+        settings = CONFIG["INGEST_QUEUE"]
+        if settings["backend"] == "local":
+            _QUEUE = LocalQueue()
+        elif settings["backend"] == "sqs":
+            _QUEUE = SQSQueue(settings["queue_url"], settings.get("test_queue_url"),
+                              settings.get("visibility_timeout", 300))
+        else:
+            raise ValueError(f"Unknown ingest queue backend '{settings['backend']}'")
+    return _QUEUE
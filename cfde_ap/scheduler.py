@@ -0,0 +1,342 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import select
+import shutil
+import time
+
+from cfde_ap import CONFIG, archives
+
+logger = logging.getLogger(__name__)
+
+# Admission control for ingests, shared by every process on this host through
+# files in SCHEDULER_DIR. Each running ingest holds a reservation of the disk space
+# it is expected to use in DATA_DIR ("running/"). An ingest which would overrun
+# the disk budget, or find no free slot, is not claimed by the ingest worker until
+# running ingests finish. Jobs of the local ingest queue wait in "queue/". Test
+# submissions have their own lane with separate slots, so they are never stuck
+# behind production loads. Within a lane, queued ingests are claimed
+# weighted-fairly between DCCs, so one DCC with many submissions cannot starve
+# the others. Each reservation records the pid of the process which owns it, the
+# worker until the ingest process starts, see set_owner(). Reservations whose owner
+# has died without releasing them are reclaimed before admitting new jobs. All
+# changes are made under an exclusive lock on SCHEDULER_DIR/lock. A worker waiting
+# for jobs is woken through the SCHEDULER_DIR/wakeup FIFO as soon as one is queued.
+
+
+def _get_dir(subdir):
+    path = os.path.join(CONFIG["SCHEDULER_DIR"], subdir)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextlib.contextmanager
+def _locked():
+    # Processes must never be started while holding the lock, children would
+    # inherit the locked file descriptor
+    with open(os.path.join(_get_dir(""), "lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+_WAKEUP_FD = None
+
+
+def _get_wakeup_path():
+    path = os.path.join(_get_dir(""), "wakeup")
+    try:
+        os.mkfifo(path, 0o600)
+    except FileExistsError:
+        pass
+    return path
+
+
+def _notify():
+    """Wake the worker waiting in wait_for_jobs(), if there is one."""
+    try:
+        fd = os.open(_get_wakeup_path(), os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        # No worker has the FIFO open, it claims the job on its next poll
+        return
+    try:
+        os.write(fd, b"\0")
+    except BlockingIOError:
+        # The FIFO is full of wakeups not yet read, one more adds nothing
+        pass
+    finally:
+        os.close(fd)
+
+
+def wait_for_jobs(timeout):
+    """Wait up to timeout seconds, returning early when a job is queued."""
+    global _WAKEUP_FD
+    if _WAKEUP_FD is None:
+        # Opened for writing as well, so the FIFO never reads as closed, and wakeups
+        # sent between two waits stay in it
+        _WAKEUP_FD = os.open(_get_wakeup_path(), os.O_RDWR | os.O_NONBLOCK)
+    readable, _, _ = select.select([_WAKEUP_FD], [], [], timeout)
+    if readable:
+        try:
+            os.read(_WAKEUP_FD, 4096)
+        except BlockingIOError:
+            pass
+
+
+def _read_jobs(subdir):
+    jobs = []
+    for entry in os.scandir(_get_dir(subdir)):
+        if entry.name.endswith(".json"):
+            try:
+                with open(entry.path) as f:
+                    jobs.append(json.load(f))
+            except FileNotFoundError:
+                continue
+    return sorted(jobs, key=lambda job: job["queued_at"])
+
+
+def _write_job(subdir, job):
+    path = os.path.join(_get_dir(subdir), f"{job['action_id']}.json")
+    tmp_path = f"{path}.{os.getpid()}"
+    # Jobs hold the ingest arguments, with the submitting user's identity
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        json.dump(job, f)
+    os.replace(tmp_path, path)
+
+
+def _remove_job(subdir, action_id):
+    try:
+        os.remove(os.path.join(_get_dir(subdir), f"{action_id}.json"))
+    except FileNotFoundError:
+        pass
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_running():
+    """Return the running jobs, after removing the reservations of jobs whose owning
+    process no longer exists. Must be called under the lock."""
+    running = []
+    for job in _read_jobs("running"):
+        if job.get("owner_pid") is not None and not _is_alive(job["owner_pid"]):
+            logger.warning(f"{job['action_id']}: Owner process {job['owner_pid']} is gone, "
+                           f"reclaiming its reservation of {_get_disk_usage(job)} bytes")
+            _remove_job("running", job["action_id"])
+        else:
+            running.append(job)
+    return running
+
+
+def get_disk_budget():
+    """Return the number of bytes running ingests may use in DATA_DIR. The archive
+    cache is kept in DATA_DIR between ingests, so the space it takes is not part of
+    the budget."""
+    if CONFIG["INGEST_DISK_BUDGET"] is not None:
+        budget = CONFIG["INGEST_DISK_BUDGET"]
+    else:
+        budget = int(shutil.disk_usage(CONFIG["DATA_DIR"]).total * 0.8)
+    return max(budget - archives.get_cache_size(), 0)
+
+
+def estimate_disk_usage(archive_size):
+    """Estimate the bytes an ingest uses in DATA_DIR, from its archive's size. The
+    archive is cached, downloaded and unpacked, so this is a multiple of its size."""
+    return int(archive_size * CONFIG["INGEST_DISK_USAGE_FACTOR"])
+
+
+def _get_disk_usage(job):
+    # Ingests of unknown size are assumed to need the whole budget, so they run
+    # only alone, or once the host is idle
+    if job["disk_usage"] is None:
+        return get_disk_budget()
+    return job["disk_usage"]
+
+
+def _get_lane(job):
+    return "test" if job.get("test_sub") else "production"
+
+
+def _has_slot(job, running):
+    lane_running = [r for r in running if _get_lane(r) == _get_lane(job)
+                    and r.get("stage") != "transfer" and r["action_id"] != job["action_id"]]
+    lane_slots = (CONFIG["TEST_INGEST_SLOTS"] if _get_lane(job) == "test"
+                  else CONFIG["MAX_CONCURRENT_INGESTS"])
+    return len(lane_running) < lane_slots
+
+
+def _fits(job, running):
+    # Jobs waiting on a transfer only need disk, they take a slot once it is done
+    if job.get("stage") != "transfer" and not _has_slot(job, running):
+        return False
+    disk_usage = _get_disk_usage(job)
+    if disk_usage <= CONFIG["SMALL_INGEST_BYTES"] or not running:
+        # Small ingests always fit on disk, and so does any ingest on an idle host,
+        # so an ingest larger than the whole budget still runs eventually
+        return True
+    reserved = sum(_get_disk_usage(r) for r in running)
+    return reserved + disk_usage <= get_disk_budget()
+
+
+def _fair_order(queue, running):
+    """Return queued jobs in admission order: the test lane first, then production.
+    Within a lane, jobs are interleaved between DCCs by weighted fair sharing. Each
+    DCC's share starts at its running ingests divided by its weight (DCC_WEIGHTS,
+    default 1). The DCC with the lowest share goes next with its oldest job, and
+    its share grows by 1/weight."""
+    ordered = []
+    for lane in ("test", "production"):
+        by_dcc = {}
+        for job in queue:
+            if _get_lane(job) == lane:
+                by_dcc.setdefault(job.get("dcc_id"), []).append(job)
+        weights = {dcc: CONFIG["DCC_WEIGHTS"].get(dcc, 1) for dcc in by_dcc}
+        shares = {dcc: sum(1 for r in running
+                           if _get_lane(r) == lane and r.get("dcc_id") == dcc) / weights[dcc]
+                  for dcc in by_dcc}
+        while by_dcc:
+            dcc = min(by_dcc, key=lambda d: (shares[d], by_dcc[d][0]["queued_at"]))
+            ordered.append(by_dcc[dcc].pop(0))
+            shares[dcc] += 1 / weights[dcc]
+            if not by_dcc[dcc]:
+                del by_dcc[dcc]
+    return ordered
+
+
+def _may_use_test_lane(archive_size, dcc_id):
+    """Return True if a test submission may skip the production queue. The test_sub
+    flag is the submitter's, so the lane is kept to small archives and, if
+    TEST_LANE_DCCS is set, to the DCCs it lists."""
+    if archive_size is None or archive_size > CONFIG["TEST_LANE_MAX_BYTES"]:
+        return False
+    return CONFIG["TEST_LANE_DCCS"] is None or dcc_id in CONFIG["TEST_LANE_DCCS"]
+
+
+def new_job(action_id, args, archive_size, dcc_id=None, test_sub=False, transfer=False):
+    """Return a job for an ingest, to hand to an ingest queue.
+
+    Arguments:
+        action_id (str): The ID for the action.
+        args (dict): The JSON-serializable keyword arguments for the ingest.
+        archive_size (int): The size of the archive to ingest, in bytes, or None if
+                it is unknown. Ingests of unknown size are budgeted as large.
+        dcc_id (str): The DCC submitting, for fair sharing. Default None.
+        test_sub (bool): True for test submissions, which use the test lane if
+                allowed by TEST_LANE_MAX_BYTES and TEST_LANE_DCCS. Default False.
+        transfer (bool): True if the ingest must first wait for its data to be
+                transferred. Such ingests take a slot only once the transfer is
+                done, see start_ingest_stage(). Default False.
+    """
+    if test_sub and not _may_use_test_lane(archive_size, dcc_id):
+        logger.info(f"{action_id}: Test submission not allowed in the test lane, "
+                    f"queueing as production")
+        test_sub = False
+    return {
+        "action_id": action_id,
+        "args": args,
+        "disk_usage": estimate_disk_usage(archive_size) if archive_size is not None else None,
+        "dcc_id": dcc_id,
+        "test_sub": test_sub,
+        "stage": "transfer" if transfer else "ingest",
+        "queued_at": time.time()
+    }
+
+
+def enqueue(job):
+    """Add a job to the queue, to be claimed once it fits."""
+    with _locked():
+        _write_job("queue", job)
+    _notify()
+    logger.info(f"{job['action_id']}: Queued in {_get_lane(job)} lane, needs "
+                f"{job['disk_usage'] if job['disk_usage'] is not None else 'unknown'} "
+                f"bytes of disk")
+
+
+def claim():
+    """Take the next queued job which has a free slot and fits the disk budget, and
+    reserve its disk space for this process. A job which does not fit does not hold
+    back the jobs after it.
+
+    Returns:
+        dict: The job, or None if no queued job fits.
+    """
+    with _locked():
+        running = _read_running()
+        for job in _fair_order(_read_jobs("queue"), running):
+            if _fits(job, running):
+                job["reserved_at"] = time.time()
+                job["owner_pid"] = os.getpid()
+                _write_job("running", job)
+                _remove_job("queue", job["action_id"])
+                return job
+    return None
+
+
+def reserve(job):
+    """Reserve a slot and disk space for a job taken from elsewhere, e.g. a
+    networked queue, for this process. Returns True if the job fits, False if it
+    does not."""
+    with _locked():
+        if not _fits(job, _read_running()):
+            return False
+        job["reserved_at"] = time.time()
+        job["owner_pid"] = os.getpid()
+        _write_job("running", job)
+    return True
+
+
+def start_ingest_stage(action_id):
+    """Wait for a slot for a job which was waiting on its transfer, and take it.
+    Returns at once for jobs which already hold a slot, or hold no reservation."""
+    while True:
+        with _locked():
+            running = _read_jobs("running")
+            job = next((r for r in running if r["action_id"] == action_id), None)
+            if job is None or job.get("stage") != "transfer":
+                return
+            if _has_slot(job, running):
+                job["stage"] = "ingest"
+                _write_job("running", job)
+                return
+        time.sleep(CONFIG["WORKER_POLL_INTERVAL"])
+
+
+def set_owner(action_id, pid):
+    """Hand a job's reservation to the process running its ingest, so it is
+    reclaimed if that process dies without releasing it."""
+    with _locked():
+        path = os.path.join(_get_dir("running"), f"{action_id}.json")
+        try:
+            with open(path) as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            return
+        job["owner_pid"] = pid
+        _write_job("running", job)
+
+
+def release(action_id):
+    """Release a finished ingest's reservation."""
+    with _locked():
+        _remove_job("running", action_id)
+
+
+def cancel(action_id):
+    """Remove an ingest from the queue. Returns True if it was queued."""
+    with _locked():
+        queued = os.path.exists(os.path.join(_get_dir("queue"), f"{action_id}.json"))
+        _remove_job("queue", action_id)
+    return queued
+
+
+def list_running():
+    """Return the running jobs, oldest first."""
+    return _read_jobs("running")
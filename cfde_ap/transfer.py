@@ -1,22 +1,155 @@
 import os
 import logging
 import globus_sdk
+import time
 import urllib
 import datetime
 
-from cfde_ap.auth import get_app_token
 from cfde_ap import CONFIG, error
+from cfde_ap.clients import get_transfer_client
 
 logger = logging.getLogger(__name__)
 
 
+def check_url_path(url):
+    """Raise InvalidRequest if the path of a URL, or of a plain path, has ".."
+    segments, which could reach outside the directory it names."""
+    path = urllib.parse.unquote(urllib.parse.urlparse(url).path)
+    if ".." in path.split("/"):
+        raise error.InvalidRequest(f"Path '{path}' must not contain '..'")
+
+
+def check_submission_path(url):
+    """Raise InvalidRequest unless a URL names a file in SUBMISSION_DIR. The AP can
+    write anywhere on GCS_ENDPOINT, so it only moves or transfers submitted data
+    there, never into other DCCs' protected archives."""
+    check_url_path(url)
+    path = urllib.parse.unquote(urllib.parse.urlparse(url).path)
+    submission_dir = os.path.join(CONFIG["SUBMISSION_DIR"], "")
+    if not path.startswith(submission_dir) or path == submission_dir:
+        raise error.InvalidRequest(f"data_url must be a file in {CONFIG['SUBMISSION_DIR']}")
+
+
+def get_local_path(url):
+    """Return the local path of a file on the GCS endpoint, if its storage is mounted
+    on this host as set in GCS_LOCAL_MOUNTS, or None if it is not.
+
+    Raises InvalidRequest if the path would resolve outside its mount."""
+    check_url_path(url)
+    path = urllib.parse.unquote(urllib.parse.urlparse(url).path)
+    for gcs_prefix, mount in CONFIG["GCS_LOCAL_MOUNTS"].items():
+        if path.startswith(gcs_prefix):
+            mount = os.path.normpath(mount)
+            local_path = os.path.normpath(os.path.join(mount, path[len(gcs_prefix):]))
+            if os.path.commonpath([mount, local_path]) != mount:
+                raise error.InvalidRequest(f"Path '{path}' is outside of '{gcs_prefix}'")
+            return local_path
+    return None
+
+
+def get_file_size(endpoint_id, path):
+    """Return the size in bytes of a file on a Globus endpoint, from a Transfer listing
+    of the file, without touching its contents."""
+    tc = get_transfer_client()
+    dirname, filename = os.path.split(path)
+    listing = tc.operation_ls(endpoint_id, path=dirname, filter=f"name:{filename}")
+    for entry in listing:
+        if entry["name"] == filename:
+            return entry["size"]
+    raise error.NotFound(f"File '{path}' not found on endpoint {endpoint_id}")
+
+
+def get_archive_size(url):
+    """Return the size in bytes of a submitted archive on the GCS endpoint."""
+    return get_file_size(CONFIG["GCS_ENDPOINT"], urllib.parse.urlparse(url).path)
+
+
+def file_exists(url):
+    """Return True if the file at a URL on the GCS endpoint exists."""
+    local_path = get_local_path(url)
+    if local_path:
+        return os.path.isfile(local_path)
+    try:
+        get_archive_size(url)
+    except error.NotFound:
+        return False
+    return True
+
+
+def get_submission_id():
+    return get_transfer_client().get_submission_id()["value"]
+
+
+def submit_transfer(submission_id, source_endpoint_id, source_path, url, deadline):
+    """Submit a transfer of one file to the GCS endpoint. Submitting again with the
+    same submission_id does not start a second transfer.
+
+    Arguments:
+        submission_id (str): The Transfer submission ID, from get_submission_id().
+        source_endpoint_id (str): The endpoint to transfer from. It must allow the
+                Action Provider's client to read source_path.
+        source_path (str): The path of the file on the source endpoint.
+        url (str): The HTTPS URL of the destination on the GCS endpoint.
+        deadline (float): The time, as a timestamp, by which the transfer must finish.
+
+    Returns:
+        str: The transfer task ID.
+    """
+    tc = get_transfer_client()
+    tdata = globus_sdk.TransferData(
+        tc, source_endpoint_id, CONFIG["GCS_ENDPOINT"],
+        label="CFDE submission transfer", submission_id=submission_id, verify_checksum=True,
+        deadline=datetime.datetime.fromtimestamp(deadline, datetime.timezone.utc).isoformat())
+    tdata.add_item(source_path, urllib.parse.urlparse(url).path)
+    return tc.submit_transfer(tdata)["task_id"]
+
+
+def wait_for_transfer(task_id, deadline):
+    """Wait for a transfer task to succeed. The task is checked every
+    TRANSFER_MIN_PING_INTERVAL seconds at first, doubling up to TRANSFER_PING_INTERVAL,
+    so small transfers are noticed quickly and long ones are not polled needlessly.
+
+    Arguments:
+        task_id (str): The transfer task ID.
+        deadline (float): The time, as a timestamp, after which the task is cancelled.
+
+    Raises exception if the task fails or is not finished by the deadline.
+    """
+    tc = get_transfer_client()
+    interval = CONFIG["TRANSFER_MIN_PING_INTERVAL"]
+    while True:
+        task = tc.get_task(task_id)
+        if task["status"] == "SUCCEEDED":
+            logger.info(f"Transfer {task_id} succeeded")
+            return
+        if task["status"] == "FAILED":
+            raise error.ServiceError(f"Transfer {task_id} failed: "
+                                     f"{task.get('nice_status_short_description')}")
+        if time.time() >= deadline:
+            try:
+                tc.cancel_task(task_id)
+            except globus_sdk.exc.TransferAPIError as tapie:
+                logger.warning(f"Could not cancel transfer {task_id}: {tapie}")
+            raise error.ServiceError(f"Transfer {task_id} did not finish within "
+                                     f"{CONFIG['TRANSFER_DEADLINE']} seconds")
+        time.sleep(min(interval, max(deadline - time.time(), 0)))
+        interval = min(interval * 2, CONFIG["TRANSFER_PING_INTERVAL"])
+
+
+def create_dir(tc, path):
+    """Create a directory on the GCS endpoint, if it does not already exist."""
+    try:
+        tc.operation_mkdir(CONFIG["GCS_ENDPOINT"], path)
+        logger.info(f"Created directory {path}")
+    except globus_sdk.exc.TransferAPIError as tapie:
+        # Another ingest may have just created it
+        if tapie.code != "ExternalError.MkdirFailed.Exists":
+            raise
+
+
 def move_to_protected_location(url, action_id, dcc_id):
     """Move user submitted datasets to a read-only location, where only the
     Action Provider has write access"""
-    transfer_token = get_app_token(CONFIG["DEPENDENT_SCOPES"]["transfer"])
-    auth = globus_sdk.AccessTokenAuthorizer(transfer_token)
-    tc = globus_sdk.TransferClient(authorizer=auth)
-
     purl = urllib.parse.urlparse(url)
     # DCCs *should* always be of the pattern "cfde_registry_dcc:kidsfirst"
     _, dcc_name = dcc_id.rsplit(":", 1)
@@ -28,13 +161,33 @@ def move_to_protected_location(url, action_id, dcc_id):
     new_filename = f"{datetime.datetime.now().isoformat()}-{action_id}{old_ext}"
     new_dataset_path = os.path.join(dcc_dir, new_filename)
     logger.debug(f'Renaming dataset "{purl.path}" to "{new_dataset_path}"')
-    try:
-        tc.operation_rename(CONFIG["GCS_ENDPOINT"], purl.path, new_dataset_path)
-    except globus_sdk.exc.TransferAPIError as tapie:
-        if tapie.code == "EndpointError":
-            raise error.DeveloperError(f"Failed to rename '{purl.path}' to '{new_dataset_path}', "
-                                       f"Check {dcc_dir} exists!") from tapie
-        raise
+    local_path = get_local_path(url)
+    new_local_path = get_local_path(new_dataset_path)
+    if local_path and new_local_path:
+        # The storage is mounted here, rename directly instead of through Transfer
+        try:
+            os.rename(local_path, new_local_path)
+        except FileNotFoundError:
+            # The DCC directory is created the first time the DCC submits
+            os.makedirs(os.path.dirname(new_local_path), exist_ok=True)
+            os.rename(local_path, new_local_path)
+    else:
+        tc = get_transfer_client()
+        try:
+            tc.operation_rename(CONFIG["GCS_ENDPOINT"], purl.path, new_dataset_path)
+        except globus_sdk.exc.TransferAPIError as tapie:
+            if tapie.code != "EndpointError":
+                raise
+            # The rename is tried first as the DCC directory almost always exists,
+            # which saves a call. A missing directory is created, then renamed into.
+            create_dir(tc, dcc_dir)
+            try:
+                tc.operation_rename(CONFIG["GCS_ENDPOINT"], purl.path, new_dataset_path)
+            except globus_sdk.exc.TransferAPIError as tapie:
+                if tapie.code == "EndpointError":
+                    raise error.DeveloperError(f"Failed to rename '{purl.path}' to "
+                                               f"'{new_dataset_path}'") from tapie
+                raise
     url = urllib.parse.urlunparse((purl.scheme, purl.netloc, new_dataset_path, "", "", ""))
     logger.debug(f"Successfully updated dataset URL to {url}")
     return url
@@ -1,23 +1,19 @@
 from copy import deepcopy
+from decimal import Decimal
 import logging
 import os
 import shutil
 import uuid
 
-import boto3
 from boto3.dynamodb.conditions import Attr
 import mdf_toolbox
 
 from cfde_ap import CONFIG
-from . import error as err
+from . import clients, error as err
 
 
 logger = logging.getLogger(__name__)
 
-DMO_CLIENT = boto3.resource('dynamodb',
-                            aws_access_key_id=CONFIG["AWS_KEY"],
-                            aws_secret_access_key=CONFIG["AWS_SECRET"],
-                            region_name="us-east-1")
 DMO_SCHEMA = {
     "AttributeDefinitions": [{
         "AttributeName": "action_id",
@@ -35,12 +31,15 @@ DMO_SCHEMA = {
 
 
 def clean_environment():
-    # Delete data dir and remake
-    try:
-        shutil.rmtree(CONFIG["DATA_DIR"])
-    except FileNotFoundError:
-        pass
-    os.makedirs(CONFIG["DATA_DIR"])
+    # Empty data dir, keeping the archive cache so retries can still use it
+    os.makedirs(CONFIG["DATA_DIR"], exist_ok=True)
+    for entry in os.scandir(CONFIG["DATA_DIR"]):
+        if entry.path == os.path.normpath(CONFIG["ARCHIVE_CACHE_DIR"]):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
     # Clear old exceptional error log
     try:
         os.remove("ERROR.log")
@@ -48,7 +47,7 @@ def clean_environment():
         pass
 
 
-def initialize_dmo_table(table_name, schema=DMO_SCHEMA, client=DMO_CLIENT):
+def initialize_dmo_table(table_name, schema=DMO_SCHEMA, client=None):
     """Init a table in DynamoDB, by default the DMO_TABLE with DMO_SCHEMA.
 
     Arguments:
@@ -56,13 +55,14 @@ def initialize_dmo_table(table_name, schema=DMO_SCHEMA, client=DMO_CLIENT):
         schema (dict): The schema for the DynamoDB table.
                 Default DMO_SCHEMA.
         client (dynamodb.ServiceResource): An authenticated client for DynamoDB.
-                Default DMO_CLIENT.
+                Default None to use this process's client from clients.get_dynamodb().
 
     Returns:
         dynamodb.Table: The created DynamoDB table.
 
     Raises exception on any failure.
     """
+    client = client or clients.get_dynamodb()
     # Table should not be active already
     try:
         table = get_dmo_table(table_name, client)
@@ -92,19 +92,20 @@ def initialize_dmo_table(table_name, schema=DMO_SCHEMA, client=DMO_CLIENT):
     return table2
 
 
-def get_dmo_table(table_name, client=DMO_CLIENT):
+def get_dmo_table(table_name, client=None):
     """Return a DynamoDB table, by default the DMO_TABLE.
 
     Arguments:
         table_name (str): The name of the DynamoDB table.
         client (dynamodb.ServiceResource): An authenticated client for DynamoDB.
-                Default DMO_CLIENT.
+                Default None to use this process's client from clients.get_dynamodb().
 
     Returns:
         dynamodb.Table: The requested DynamoDB table.
 
     Raises exception on any failure.
     """
+    client = client or clients.get_dynamodb()
     try:
         table = client.Table(table_name)
         dmo_status = table.table_status
@@ -135,6 +136,8 @@ def create_action_status(table_name, action_status):
     # TODO: Add default status information
     action_id = str(uuid.uuid1())
     action_status["action_id"] = action_id
+    # Incremented on every update, to tell clients whether the status changed
+    action_status["version"] = 0
     if not action_status.get("details"):
         action_status["details"] = {
             "message": "Action started"
@@ -193,13 +196,62 @@ def read_action_by_request(table_name, request_id):
     Returns:
         dict: The requested action status.
 
+    Raises exception on any failure.
+    """
+    result_entries = scan_action_statuses(table_name, Attr("request_id").eq(request_id))
+
+    # Should be exactly 0 or 1 result, 2+ should never happen
+    if len(result_entries) <= 0:
+        raise err.NotFound("Request ID '{}' not found in status database".format(request_id))
+    elif len(result_entries) == 1:
+        return result_entries[0]
+    else:
+        logger.error("Multiple entries found for request ID '{}'!".format(request_id))
+        raise err.InternalError("Multiple entries found for request ID '{}'. "
+                                "Please report this error.".format(request_id))
+
+
+def read_action_by_digest(table_name, dcc_id, archive_digest):
+    """Fetch a successful action which ingested an identical archive for a DCC.
+    This requires scanning the DynamoDB table.
+
+    Arguments:
+        table_name (str): The name of the table to read from.
+        dcc_id (str): The DCC the archive was submitted for.
+        archive_digest (str): The sha256 hex digest of the archive.
+
+    Returns:
+        dict: The most recently started matching action status.
+
+    Raises exception on any failure.
+    """
+    filter_expression = (Attr("status").eq("SUCCEEDED")
+                         & Attr("details.dcc_id").eq(dcc_id)
+                         & Attr("details.archive_digest").eq(archive_digest))
+    result_entries = scan_action_statuses(table_name, filter_expression)
+    if not result_entries:
+        raise err.NotFound("No successful submission with digest '{}' found for {}"
+                           .format(archive_digest, dcc_id))
+    return max(result_entries, key=lambda entry: entry["date_started"])
+
+
+def scan_action_statuses(table_name, filter_expression):
+    """Fetch all action entries matching a filter. This scans the DynamoDB table.
+
+    Arguments:
+        table_name (str): The name of the table to read from.
+        filter_expression (boto3.dynamodb.conditions.ConditionBase): The filter to apply.
+
+    Returns:
+        list: The matching action statuses.
+
     Raises exception on any failure.
     """
     table = get_dmo_table(table_name)
 
     scan_args = {
         "ConsistentRead": True,
-        "FilterExpression": Attr("request_id").eq(request_id)
+        "FilterExpression": filter_expression
     }
     # Make scan call, paging through if too many entries are scanned
     result_entries = []
@@ -220,16 +272,7 @@ def read_action_by_request(table_name, request_id):
         # Otherwise, all results retrieved
         else:
             break
-
-    # Should be exactly 0 or 1 result, 2+ should never happen
-    if len(result_entries) <= 0:
-        raise err.NotFound("Request ID '{}' not found in status database".format(request_id))
-    elif len(result_entries) == 1:
-        return result_entries[0]
-    else:
-        logger.error("Multiple entries found for request ID '{}'!".format(request_id))
-        raise err.InternalError("Multiple entries found for request ID '{}'. "
-                                "Please report this error.".format(request_id))
+    return result_entries
 
 
 def update_action_status(table_name, action_id, updates, overwrite=False):
@@ -259,6 +302,7 @@ def update_action_status(table_name, action_id, updates, overwrite=False):
         full_updates = mdf_toolbox.dict_merge(updates, old_status)
     else:
         full_updates = updates
+    full_updates["version"] = old_status.get("version", 0) + 1
 
     # TODO: Validate updates
     update_errors = []
@@ -277,6 +321,35 @@ def update_action_status(table_name, action_id, updates, overwrite=False):
     return full_updates
 
 
+def claim_action_host(table_name, action_id, host):
+    """Record the host running an action's ingest, unless another host already runs
+    it. The write is conditional, so only one host can ever claim an action.
+
+    Arguments:
+        table_name (str): The name of the table to update.
+        action_id (str): The ID for the action.
+        host (str): The name of the claiming host.
+
+    Returns:
+        bool: True if the action is claimed by host, False if by another host.
+
+    Raises exception on any other failure.
+    """
+    table = get_dmo_table(table_name)
+    try:
+        table.update_item(Key={"action_id": action_id},
+                          UpdateExpression="SET ingest_host = :host",
+                          ConditionExpression=(Attr("ingest_host").not_exists()
+                                               | Attr("ingest_host").eq(host)),
+                          ExpressionAttributeValues={":host": host})
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    except Exception as e:
+        logger.error("Error claiming '{}' for {}: {}".format(action_id, host, str(e)))
+        raise err.ServiceError(str(e))
+    return True
+
+
 def delete_action_status(table_name, action_id):
     """Release an action entry from the database.
 
@@ -321,8 +394,23 @@ def translate_status(raw_status):
     Returns:
         dict: The translated status.
     """
-    # TODO
-    # DynamoDB stores int as Decimal, which isn't JSON-friendly
-    # if raw_status.get("details", {}).get("deriva_id"):
-    #     raw_status["details"]["deriva_id"] = int(raw_status["details"]["deriva_id"])
-    return raw_status
+    # The version is internal, clients see it as the status's ETag
+    status = {key: value for key, value in raw_status.items()
+              if key not in ("version", "ingest_deadline")}
+    # DynamoDB stores numbers as Decimal, which isn't JSON-friendly
+    return _from_decimal(status)
+
+
+def get_status_etag(raw_status):
+    """Return the ETag of an action status, which changes whenever the status does."""
+    return f"{raw_status['action_id']}-{raw_status.get('version', 0)}"
+
+
+def _from_decimal(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {k: _from_decimal(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_from_decimal(v) for v in value]
+    return value
@@ -0,0 +1,325 @@
+import csv
+import datetime
+import io
+from itertools import islice
+import json
+import logging
+import posixpath
+import re
+
+import numpy as np
+
+from cfde_ap import CONFIG
+
+logger = logging.getLogger(__name__)
+
+_INTEGER = re.compile(r"[+-]?[0-9]+")
+_DATE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+
+class ArchiveValidationError(ValueError):
+    """The submitted archive is invalid. Holds a list of short error descriptions."""
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("Submission is invalid: " + "; ".join(errors))
+
+
+def validate_tsv_structure(name, fileobj, max_errors=None):
+    """Check that a TSV file is UTF-8 and every row has as many fields as the header.
+    The file is read one line at a time, so memory use does not depend on file size.
+
+    Arguments:
+        name (str): The name of the file, for error messages.
+        fileobj (file): The TSV file, opened in binary mode.
+        max_errors (int): Stop after this many errors.
+                Default None to use VALIDATION_MAX_ERRORS.
+
+    Returns:
+        list of str: The errors found. Empty if the file is valid.
+    """
+    max_errors = max_errors or CONFIG["VALIDATION_MAX_ERRORS"]
+    errors = []
+    n_fields = None
+    # Archive members streamed from a download are not seekable, which rules out
+    # io.TextIOWrapper, so lines are decoded one by one
+    for line_num, line in enumerate(fileobj, start=1):
+        try:
+            line = line.decode("utf-8")
+        except UnicodeDecodeError as e:
+            errors.append(f"{name} line {line_num}: not valid UTF-8 ({e.reason})")
+        else:
+            row_fields = len(line.rstrip("\r\n").split("\t"))
+            if n_fields is None:
+                n_fields = row_fields
+            elif row_fields != n_fields:
+                errors.append(f"{name} line {line_num}: expected {n_fields} fields, "
+                              f"found {row_fields}")
+        if len(errors) >= max_errors:
+            break
+    if n_fields is None and not errors:
+        errors.append(f"{name}: file is empty")
+    return errors
+
+
+def validate_archive_member(name, fileobj):
+    """Validate one file from a submission archive while the archive streams in.
+    Only TSV files are checked.
+
+    Raises ArchiveValidationError on the first invalid file.
+    """
+    if not name.endswith(".tsv"):
+        return
+    logger.debug(f"Validating {name}")
+    errors = validate_tsv_structure(name, fileobj)
+    if errors:
+        raise ArchiveValidationError(errors)
+
+
+class _ErrorReport(object):
+    """Collects errors as counts per (file, problem), keeping the first line seen."""
+    def __init__(self):
+        self.errors = {}
+
+    def add(self, name, problem, count=1, line_num=None):
+        if not count:
+            return
+        entry = self.errors.setdefault((name, problem), [0, line_num])
+        entry[0] += count
+        if entry[1] is None:
+            entry[1] = line_num
+
+    def summary(self):
+        lines = []
+        for (name, problem), (count, line_num) in self.errors.items():
+            where = f" (first at line {line_num})" if line_num is not None else ""
+            lines.append(f"{name}: {count} {problem}{where}")
+        return lines
+
+
+def _elementwise(values, check):
+    """Return a mask of values for which check() raises ValueError. Used where numpy
+    cannot parse a whole column at once."""
+    def is_bad(value):
+        try:
+            check(value)
+        except ValueError:
+            return True
+        return False
+    return np.frompyfunc(is_bad, 1, 1)(values).astype(bool)
+
+
+def _check_integer(value):
+    if not _INTEGER.fullmatch(value):
+        raise ValueError(value)
+
+
+def _check_date(value):
+    # numpy and fromisoformat() accept partial or compact dates, DERIVA does not
+    if not _DATE.fullmatch(value):
+        raise ValueError(value)
+    datetime.date.fromisoformat(value)
+
+
+def _find_bad_values(values, field):
+    """Return a mask of the values, an object array of non-empty strings, which do
+    not match the field's type or enum constraint. Dates and datetimes are checked
+    in their default ISO format or a strptime pattern format, those with format
+    "any" are left for DERIVA to parse."""
+    field_type = field.get("type", "string")
+    field_format = field.get("format", "default")
+    if field_type in ("date", "datetime") and field_format == "any":
+        field_type = "string"
+    if field_type == "integer":
+        bad = _elementwise(values, _check_integer)
+    elif field_type == "number":
+        try:
+            values.astype(np.float64)
+            bad = np.zeros(len(values), dtype=bool)
+        except ValueError:
+            bad = _elementwise(values, float)
+    elif field_type == "boolean":
+        allowed = (field.get("trueValues", ["true", "True", "TRUE", "1"])
+                   + field.get("falseValues", ["false", "False", "FALSE", "0"]))
+        bad = ~np.isin(values, allowed)
+    elif field_type in ("date", "datetime") and field_format != "default":
+        pattern = field_format[len("fmt:"):] if field_format.startswith("fmt:") else field_format
+        bad = _elementwise(values, lambda value: datetime.datetime.strptime(value, pattern))
+    elif field_type == "date":
+        bad = _elementwise(values, _check_date)
+    elif field_type == "datetime":
+        bad = _elementwise(values, datetime.datetime.fromisoformat)
+    else:
+        bad = np.zeros(len(values), dtype=bool)
+    enum = field.get("constraints", {}).get("enum")
+    if enum:
+        bad |= ~np.isin(values, enum)
+    return bad
+
+
+def _hash_keys(columns):
+    """Hash the key made of one or more columns of a chunk into an int64 array."""
+    if len(columns) == 1:
+        keys = columns[0]
+    else:
+        # Tabs cannot appear inside TSV values, so they separate key parts unambiguously
+        keys = map("\t".join, zip(*columns))
+    return np.fromiter(map(hash, keys), dtype=np.int64, count=len(columns[0]))
+
+
+def _validate_table(name, fileobj, resource, key_sets, report):
+    """Validate one TSV file in chunks of VALIDATION_CHUNK_ROWS rows, checking types
+    and required values per column. The hashes of every key in key_sets[resource]
+    are collected for the uniqueness and foreign key checks."""
+    fields = {field["name"]: field for field in resource.get("schema", {}).get("fields", [])}
+    primary_key = resource.get("schema", {}).get("primaryKey", [])
+    if isinstance(primary_key, str):
+        primary_key = [primary_key]
+    reader = csv.reader(io.TextIOWrapper(fileobj, encoding="utf-8", newline=""),
+                        delimiter="\t", quoting=csv.QUOTE_NONE)
+    header = next(reader, None)
+    if header is None:
+        report.add(name, "missing header row")
+        return
+    for column in header:
+        if column not in fields:
+            report.add(name, f"unknown column '{column}'")
+    for field_name, field in fields.items():
+        required = (field.get("constraints", {}).get("required") or field_name in primary_key)
+        if field_name not in header and required:
+            report.add(name, f"missing required column '{field_name}'")
+    index = {column: i for i, column in enumerate(header)}
+    key_hashes = {key: [] for key in key_sets[resource["name"]]}
+
+    line_num = 2
+    while True:
+        rows = list(islice(reader, CONFIG["VALIDATION_CHUNK_ROWS"]))
+        if not rows:
+            break
+        short = [i for i, row in enumerate(rows) if len(row) != len(header)]
+        if short:
+            report.add(name, "rows with the wrong number of fields", len(short),
+                       line_num + short[0])
+            rows = [row for row in rows if len(row) == len(header)]
+        if rows:
+            # Object arrays of the row's own strings. A fixed-width string array would
+            # make every value as wide as the longest in the chunk.
+            chunk = [np.array(column, dtype=object) for column in zip(*rows)]
+            for column, i in index.items():
+                field = fields.get(column)
+                if field is None:
+                    continue
+                values = chunk[i]
+                empty = values == ""
+                if field.get("constraints", {}).get("required") or column in primary_key:
+                    empties = np.flatnonzero(empty)
+                    if len(empties):
+                        report.add(name, f"empty values in required column '{column}'",
+                                   len(empties), line_num + empties[0])
+                bad = np.flatnonzero(~empty)[_find_bad_values(values[~empty], field)]
+                if len(bad):
+                    report.add(name, f"values in '{column}' that are not a valid "
+                               f"{field.get('type', 'string')}", len(bad), line_num + bad[0])
+            for key, hashes in key_hashes.items():
+                if all(column in index for column in key):
+                    columns = [chunk[index[column]] for column in key]
+                    # Keys with an empty part are null and take no part in key checks
+                    present = np.all([column != "" for column in columns], axis=0)
+                    hashes.append(_hash_keys([column[present] for column in columns]))
+        line_num += len(rows) + len(short)
+
+    for key, hashes in key_hashes.items():
+        key_sets[resource["name"]][key] = (np.concatenate(hashes) if hashes
+                                           else np.zeros(0, dtype=np.int64))
+    if primary_key and tuple(primary_key) in key_hashes:
+        _, counts = np.unique(key_sets[resource["name"]][tuple(primary_key)],
+                              return_counts=True)
+        report.add(name, f"duplicate values of primary key {primary_key}",
+                   int((counts > 1).sum()))
+
+
+def _find_datapackage(members):
+    """Return the name and contents of the datapackage JSON file among members."""
+    for name, open_member in members.items():
+        if not name.endswith(".json"):
+            continue
+        with open_member() as f:
+            try:
+                doc = json.load(f)
+            except ValueError:
+                continue
+        if isinstance(doc, dict) and isinstance(doc.get("resources"), list):
+            return name, doc
+    raise ArchiveValidationError(["No datapackage JSON file found in the archive"])
+
+
+def validate_datapackage(members):
+    """Validate the TSV tables of a C2M2 datapackage against its table schema before
+    anything is loaded. Each file is read once, in chunks, with checks run on whole
+    columns at a time. Checked are column names, required values, value types and
+    enums, primary key uniqueness, and foreign key references. Keys are compared as
+    64-bit hashes, so memory use is 8 bytes per key per row. Tables are read in the
+    order they are stored in the archive, so a compressed archive is read through
+    once rather than decompressed again from the start for each table.
+
+    Arguments:
+        members (dict): The archive's files, as given by archives.open_archive().
+
+    Raises ArchiveValidationError listing the number and first line of each kind of
+    error in each file.
+    """
+    dp_name, datapackage = _find_datapackage(members)
+    base_dir = posixpath.dirname(dp_name)
+    resources = {resource["name"]: resource for resource in datapackage["resources"]
+                 if resource.get("path")}
+    report = _ErrorReport()
+
+    # Collect the keys needed: each table's primary key, and every referenced key
+    key_sets = {name: {} for name in resources}
+    foreign_keys = []
+    for name, resource in resources.items():
+        schema = resource.get("schema", {})
+        primary_key = schema.get("primaryKey")
+        if primary_key:
+            key_sets[name][tuple([primary_key] if isinstance(primary_key, str)
+                                 else primary_key)] = None
+        for fkey in schema.get("foreignKeys", []):
+            fields = fkey["fields"]
+            ref_fields = fkey["reference"]["fields"]
+            fields = tuple([fields] if isinstance(fields, str) else fields)
+            ref_fields = tuple([ref_fields] if isinstance(ref_fields, str) else ref_fields)
+            ref_name = fkey["reference"].get("resource") or name
+            if ref_name not in resources:
+                continue
+            key_sets[name][fields] = None
+            key_sets[ref_name][ref_fields] = None
+            foreign_keys.append((name, fields, ref_name, ref_fields))
+
+    by_path = {}
+    for resource in resources.values():
+        path = posixpath.normpath(posixpath.join(base_dir, resource["path"]))
+        if path in members:
+            by_path[path] = resource
+        else:
+            report.add(resource["path"], "file listed in the datapackage is missing")
+    # members is in archive order
+    for path, open_member in members.items():
+        resource = by_path.get(path)
+        if resource is None:
+            continue
+        logger.debug(f"Validating table {resource['name']}")
+        with open_member() as f:
+            _validate_table(resource["path"], f, resource, key_sets, report)
+
+    for name, fields, ref_name, ref_fields in foreign_keys:
+        fk_hashes = key_sets[name].get(fields)
+        ref_hashes = key_sets[ref_name].get(ref_fields)
+        if fk_hashes is None or ref_hashes is None:
+            continue
+        missing = int((~np.isin(fk_hashes, ref_hashes)).sum())
+        report.add(resources[name]["path"],
+                   f"values of {list(fields)} not found in {ref_name} {list(ref_fields)}",
+                   missing)
+
+    errors = report.summary()
+    if errors:
+        raise ArchiveValidationError(errors)
@@ -0,0 +1,162 @@
+import logging.config
+import multiprocessing
+import signal
+import time
+
+from cfde_ap import CONFIG
+from . import archives, callbacks, checkpoints, error as err, queues, scheduler, utils
+from .ingest import action_ingest
+
+
+logger = logging.getLogger(__name__)
+
+TBL = CONFIG["DYNAMO_TABLE"]
+
+# The ingest worker claims ingest jobs from the ingest queue and runs each in its
+# own process, apart from the API, so API and ingest capacity can be scaled and
+# restarted independently. Run one worker per host with:
+#     FLASK_ENV=dev python -m cfde_ap.worker
+# Ingests are started by INGEST_START_METHOD. With "forkserver", they are forked
+# from a server process which has imported only the heavy libraries ingests use,
+# so they do not copy the worker's memory or inherit its open files and locks, and
+# start without paying for those imports each time as with "spawn". Only libraries
+# which create no clients or threads on import are preloaded. Ingests import the
+# AP's own modules after the fork, and create their clients through the per-process
+# pools in cfde_ap.clients.
+INGEST_PRELOAD = ["numpy", "deriva.core", "cfde_deriva.datapackage", "cfde_deriva.submission"]
+INGEST_CONTEXT = multiprocessing.get_context(CONFIG["INGEST_START_METHOD"])
+if CONFIG["INGEST_START_METHOD"] == "forkserver":
+    INGEST_CONTEXT.set_forkserver_preload(INGEST_PRELOAD)
+
+
+_STOPPING = False
+
+
+def stop_worker(signum, frame):
+    """Stop claiming ingests, and exit once the running ones finish. Set as the
+    SIGTERM handler, see ansible/cfgs/deriva-ingest-worker.service."""
+    global _STOPPING
+    logger.info("Stopping, no more ingests are claimed")
+    _STOPPING = True
+
+
+def launch_ingest(job):
+    driver = INGEST_CONTEXT.Process(target=action_ingest, args=(job["action_id"],),
+                                    kwargs=job["args"], name=job["action_id"])
+    driver.start()
+    scheduler.set_owner(job["action_id"], driver.pid)
+    return driver
+
+
+def is_action_active(action_id):
+    """Return True if the action still wants its ingest run. Cancelled and released
+    actions do not."""
+    try:
+        return utils.read_action_status(TBL, action_id)["status"] == "ACTIVE"
+    except err.NotFound:
+        return False
+
+
+def fail_killed_ingest(action_id, exitcode, callback_targets=None):
+    """Mark an action FAILED if its ingest process died without reporting, e.g. when
+    killed at its hard CPU time limit or by the kernel for running out of memory."""
+    if not is_action_active(action_id):
+        return
+    logger.error(f"{action_id}: Ingest process died with exit code {exitcode}")
+    checkpoint = checkpoints.load_checkpoint(action_id)
+    if checkpoint is not None:
+        checkpoints.record_phase(checkpoint, "failed")
+    final_status = utils.update_action_status(TBL, action_id, {
+        "status": "FAILED",
+        "details": {
+            "error": (f"Ingest process was killed (exit code {exitcode}), it may have "
+                      f"exceeded its resource limits")
+        }
+    })
+    callbacks.send_callbacks(action_id, callback_targets, utils.translate_status(final_status))
+
+
+def resume_interrupted_ingests(ingest_queue):
+    """Restart ingests which still hold a reservation but are no longer running,
+    e.g. because the worker was restarted. Each resumes from its last checkpointed
+    phase. Returns the running ingests, as for run_worker()."""
+    running = {}
+    for job in scheduler.list_running():
+        # A held lock means the ingest is still running
+        lock = checkpoints.lock_action(job["action_id"])
+        if lock is None:
+            continue
+        lock.close()
+        checkpoint = checkpoints.load_checkpoint(job["action_id"])
+        if ((checkpoint is None or checkpoints.get_phase(checkpoint, "failed") is None)
+                and is_action_active(job["action_id"])):
+            logger.info(f"{job['action_id']}: Resuming interrupted ingest")
+            running[job["action_id"]] = (launch_ingest(job), job)
+        else:
+            archives.unpin_archives(job["action_id"])
+            ingest_queue.done(job)
+    return running
+
+
+def run_worker():
+    """Claim and run ingests until stopped. Jobs are claimed only while this host
+    has room for them, as decided by the scheduler. Once stop_worker() is called,
+    returns when the running ingests have finished."""
+    ingest_queue = queues.get_queue()
+    running = resume_interrupted_ingests(ingest_queue)
+    last_heartbeat = time.monotonic()
+    while True:
+        for action_id, (driver, job) in list(running.items()):
+            if not driver.is_alive():
+                driver.join()
+                if driver.exitcode != 0:
+                    fail_killed_ingest(action_id, driver.exitcode,
+                                       job["args"].get("callback_targets"))
+                    # A killed ingest never unpinned its archives
+                    archives.unpin_archives(action_id)
+                ingest_queue.done(job)
+                del running[action_id]
+        if time.monotonic() - last_heartbeat > CONFIG["WORKER_HEARTBEAT_INTERVAL"]:
+            for _, job in running.values():
+                ingest_queue.heartbeat(job)
+            last_heartbeat = time.monotonic()
+        callbacks.deliver_due()
+
+        if _STOPPING:
+            if not running:
+                return
+            time.sleep(CONFIG["WORKER_POLL_INTERVAL"])
+            continue
+        job = ingest_queue.claim()
+        if job is None:
+            ingest_queue.wait(CONFIG["WORKER_POLL_INTERVAL"])
+        elif not is_action_active(job["action_id"]):
+            logger.info(f"{job['action_id']}: Action is no longer active, skipping ingest")
+            ingest_queue.done(job)
+        elif job["action_id"] in running:
+            # Received again from a networked queue, e.g. after a restart, while the
+            # resumed ingest runs. It is finished with the newest receipt.
+            logger.info(f"{job['action_id']}: Ingest is already running")
+            if "receipt" in job:
+                running[job["action_id"]][1]["receipt"] = job["receipt"]
+        else:
+            logger.info(f"{job['action_id']}: Starting ingest")
+            # Ingests which transfer their data report the transfer until it is done
+            utils.update_action_status(TBL, job["action_id"], {
+                "details": {
+                    "message": ("Transferring data" if job.get("stage") == "transfer"
+                                else "Ingest started")
+                }
+            })
+            running[job["action_id"]] = (launch_ingest(job), job)
+
+
+if __name__ == "__main__":
+    logging.config.dictConfig(CONFIG["LOGGING"])
+    logger.info("\n\n==========CFDE ingest worker started==========\n")
+    # The worker owns DATA_DIR, it is cleaned here and not by the API
+    utils.clean_environment()
+    utils.initialize_dmo_table(TBL)
+    signal.signal(signal.SIGTERM, stop_worker)
+    run_worker()
+    logger.info("CFDE ingest worker stopped")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib
+import multiprocessing
+import statistics
+import time
+
+"""
+Ingest process start benchmark
+
+Starts processes the way cfde_ap.worker starts ingests, with each multiprocessing
+start method, and reports for each:
+- start latency, from Process.start() until the process is ready to ingest
+  (cfde_ap.ingest imported)
+- memory footprint of the ready process: RSS, PSS, and USS (memory private to the
+  process, which is what each extra ingest really costs)
+
+The parent first imports the --parent module, to compare forking from a small
+worker with forking from a large process such as the API.
+
+Examples:
+
+   FLASK_ENV=dev python3 ./examples/benchmark_ingest_start.py
+
+   FLASK_ENV=dev python3 ./examples/benchmark_ingest_start.py --parent cfde_ap.api --runs 20
+
+Linux only, memory is read from /proc/self/smaps_rollup.
+"""
+
+
+def read_memory():
+    """Return this process's RSS, PSS, and USS in KiB."""
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return (fields["Rss"], fields["Pss"],
+            fields["Private_Clean"] + fields["Private_Dirty"])
+
+
+def ready_ingest(started, results):
+    # With fork, cfde_ap.ingest is already loaded. With forkserver, only the
+    # libraries in INGEST_PRELOAD are, as in the worker.
+    import cfde_ap.ingest  # noqa: F401
+    results.put((time.time() - started,) + read_memory())
+
+
+def benchmark(method, runs):
+    context = multiprocessing.get_context(method)
+    if method == "forkserver":
+        from cfde_ap.worker import INGEST_PRELOAD
+        context.set_forkserver_preload(INGEST_PRELOAD)
+        # The forkserver starts with the first process, which is not a fair sample
+        warmup = context.Queue()
+        context.Process(target=ready_ingest, args=(time.time(), warmup)).start()
+        warmup.get()
+    samples = []
+    results = context.Queue()
+    for _ in range(runs):
+        proc = context.Process(target=ready_ingest, args=(time.time(), results))
+        proc.start()
+        samples.append(results.get())
+        proc.join()
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest process start benchmark")
+    parser.add_argument("--parent", default="cfde_ap.worker",
+                        help="Module imported by the parent process. Default cfde_ap.worker")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="Processes started per start method. Default 10")
+    parser.add_argument("--methods", nargs="+", default=["fork", "forkserver", "spawn"])
+    args = parser.parse_args()
+
+    importlib.import_module(args.parent)
+    rss, pss, uss = read_memory()
+    print(f"Parent ({args.parent}): RSS {rss / 1024:.1f} MiB, USS {uss / 1024:.1f} MiB")
+    print(f"{'method':<12}{'start ms (median)':>20}{'RSS MiB':>10}{'PSS MiB':>10}"
+          f"{'USS MiB':>10}")
+    for method in args.methods:
+        samples = benchmark(method, args.runs)
+        latency, rss, pss, uss = (statistics.median(column) for column in zip(*samples))
+        print(f"{method:<12}{latency * 1000:>20.1f}{rss / 1024:>10.1f}{pss / 1024:>10.1f}"
+              f"{uss / 1024:>10.1f}")
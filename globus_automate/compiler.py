@@ -0,0 +1,197 @@
+"""Compile a flow definition into an equivalent one with fewer remote hops.
+
+Every Action state is a round trip to a remote action provider, with its own
+submission and status polling, so trivial expression_eval actions which only copy
+or join strings cost as much latency as real work. compile_flow() replaces each
+expression_eval state with a Pass state which computes the same values inside the
+Flows service, storing them at the same ResultPath in the same shape
+({"details": {<result_path>: <value>}}), so later states need no changes:
+
+    - An expression which is a single argument becomes a JSONPath or literal
+      parameter, e.g. "data_url" with "data_url.$": "$.data_url"
+    - A constant expression becomes a literal parameter
+    - Any other expression becomes a ".=" expression parameter, with its arguments
+      replaced by the input values they name, e.g. "base_url + dest_path" becomes
+      "cfde_ep_url + cfde_ep_path"
+
+States which cannot be compiled this way, e.g. with an argument not given by a
+simple JSONPath, are left as they are. A Pass state cannot Catch, so a state with a
+Catch is compiled only if its expressions are all constants or single arguments,
+which cannot raise. Other expressions, e.g. str() of a value which is not a string,
+can fail, and must stay expression_eval actions for their Catch to handle it.
+Run this module to print the critical path of the flow in flow.py before and
+after compiling.
+"""
+import ast
+import copy
+import io
+import re
+import tokenize
+
+EXPRESSION_EVAL_URL = "https://actions.globus.org/expression_eval"
+SIMPLE_JSONPATH = re.compile(r"^\$((\.[A-Za-z_][A-Za-z0-9_]*)+)$")
+
+
+def is_expression_eval(state):
+    return (state.get("Type") == "Action"
+            and (state.get("ActionUrl") or "").rstrip("/") == EXPRESSION_EVAL_URL)
+
+
+def _get_arguments(expression):
+    """Return the expression's arguments as a dict of name to (is_path, value)."""
+    arguments = {}
+    for key, value in expression.get("arguments", {}).items():
+        if key.endswith(".$"):
+            arguments[key[:-2]] = (True, value)
+        else:
+            arguments[key] = (False, value)
+    return arguments
+
+
+def _substitute(text, arguments):
+    """Return the expression text with each argument name replaced by the input
+    value it names, or None if an argument cannot be inlined."""
+    replacements = {}
+    for name, (is_path, value) in arguments.items():
+        if is_path:
+            match = SIMPLE_JSONPATH.match(value)
+            if not match:
+                return None
+            replacements[name] = match.group(1)[1:]
+        else:
+            replacements[name] = repr(value)
+    tokens = list(tokenize.generate_tokens(io.StringIO(text).readline))
+    # Splice from the end of the line back, so earlier offsets stay correct
+    result = text
+    for i in reversed(range(len(tokens))):
+        tok = tokens[i]
+        if (tok.type == tokenize.NAME and tok.string in replacements
+                and tok.start[0] == 1 and not (i > 0 and tokens[i - 1].string == ".")):
+            result = result[:tok.start[1]] + replacements[tok.string] + result[tok.end[1]:]
+    return result
+
+
+def _compile_expression(expression):
+    """Return the (key, value) Pass state parameter computing one expression_eval
+    expression, or None if it cannot be compiled."""
+    result_path = expression.get("result_path")
+    text = expression.get("expression", "")
+    if not result_path or "." in result_path or "\n" in text:
+        return None
+    arguments = _get_arguments(expression)
+    if text.strip() in arguments:
+        is_path, value = arguments[text.strip()]
+        return (f"{result_path}.$", value) if is_path else (result_path, value)
+    try:
+        return result_path, ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        pass
+    try:
+        inlined = _substitute(text, arguments)
+    except (tokenize.TokenError, SyntaxError):
+        return None
+    if inlined is None:
+        return None
+    return f"{result_path}.=", inlined
+
+
+def compile_state(state):
+    """Return an equivalent Pass state for an expression_eval state, or None if
+    the state cannot be compiled."""
+    details = {}
+    for expression in state.get("Parameters", {}).get("expressions", []):
+        compiled = _compile_expression(expression)
+        if compiled is None:
+            return None
+        # An error in a Pass state fails the flow, bypassing the state's Catch
+        if state.get("Catch") and compiled[0].endswith(".="):
+            return None
+        details[compiled[0]] = compiled[1]
+    pass_state = {
+        "Type": "Pass",
+        "Parameters": {
+            "details": details
+        },
+        "ResultPath": state["ResultPath"]
+    }
+    if state.get("End"):
+        pass_state["End"] = True
+    else:
+        pass_state["Next"] = state["Next"]
+    return pass_state
+
+
+def compile_flow(definition):
+    """Return a copy of a flow definition with its expression_eval states replaced
+    by Pass states where possible.
+
+    Arguments:
+        definition (dict): The flow definition, with StartAt and States.
+
+    Returns:
+        dict: The compiled flow definition.
+    """
+    compiled = copy.deepcopy(definition)
+    for name, state in compiled["States"].items():
+        if is_expression_eval(state) and "ResultPath" in state:
+            pass_state = compile_state(state)
+            if pass_state is not None:
+                compiled["States"][name] = pass_state
+    return compiled
+
+
+def _get_next_states(state):
+    # Catch transitions are left out, they are the error path, not the run's latency
+    next_states = []
+    if state.get("Next"):
+        next_states.append(state["Next"])
+    next_states.extend(choice["Next"] for choice in state.get("Choices", []))
+    if state.get("Default"):
+        next_states.append(state["Default"])
+    return next_states
+
+
+def critical_path(definition):
+    """Return the Action states on the path through a flow with the most of them,
+    following every Next, Choice and Default transition, but not Catch transitions.
+    Each Action state is a remote round trip, so this bounds the latency of a
+    successful run.
+
+    Arguments:
+        definition (dict): The flow definition, with StartAt and States.
+
+    Returns:
+        list of str: The names of the Action states on the critical path, in order.
+    """
+    states = definition["States"]
+    longest = {}
+
+    def visit(name, visiting):
+        if name in longest:
+            return longest[name]
+        if name in visiting:
+            raise ValueError(f"Flow has a cycle through state '{name}'")
+        visiting.add(name)
+        path = max((visit(next_name, visiting) for next_name in _get_next_states(states[name])),
+                   key=len, default=[])
+        visiting.remove(name)
+        longest[name] = ([name] if states[name]["Type"] == "Action" else []) + path
+        return longest[name]
+
+    return visit(definition["StartAt"], set())
+
+
+def format_report(definition, compiled):
+    before = critical_path(definition)
+    after = critical_path(compiled)
+    removed = sorted(name for name, state in definition["States"].items()
+                     if compiled["States"][name]["Type"] != state["Type"])
+    return (f"Compiled to Pass states: {', '.join(removed) or 'none'}\n"
+            f"Critical path before: {len(before)} hops ({' -> '.join(before)})\n"
+            f"Critical path after:  {len(after)} hops ({' -> '.join(after)})")
+
+
+if __name__ == "__main__":
+    from flow import full_submission_flow_def
+    definition = full_submission_flow_def["definition"]
+    print(format_report(definition, compile_flow(definition)))
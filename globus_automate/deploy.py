@@ -1,6 +1,6 @@
 import click
 import collections
-import copy
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
 import fair_research_login
 import globus_automate_client
@@ -8,9 +8,12 @@ import globus_sdk
 import json
 import os
 import requests
+import threading
+import time
 from cfde_ap.auth import get_app_token
 from cfde_ap import CONFIG as CFDE_CONFIG
 from cfde_deriva.registry import Registry
+from compiler import compile_flow, format_report
 from flow import full_submission_flow_def
 
 native_app_id = "417301b1-5101-456a-8a27-423e71a2ae26"  # Premade native app ID
@@ -29,7 +32,8 @@ nc = fair_research_login.NativeClient(client_id=CFDE_NATIVE_APP)
 nc.login(requested_scopes=[DERIVA_SCOPE, TRANSFER_SCOPE])
 transfer_token = get_app_token(CFDE_CONFIG["DEPENDENT_SCOPES"]['transfer'])
 auth = globus_sdk.AccessTokenAuthorizer(transfer_token)
-transfer_client = globus_sdk.TransferClient(authorizer=auth)
+# Endpoints are provisioned from several threads, each with its own TransferClient
+transfer_clients = threading.local()
 
 
 def load_client_config():
@@ -44,49 +48,79 @@ def cli():
 
 @cli.command(help="Deploy the latest flow definition in flow.py")
 @click.option("--service", default="dev")  # , hidden=True)
-def deploy_flow(service):
+@click.option("--dry-run", is_flag=True, help="Show the directory and ACL changes, and stop")
+@click.option("--workers", default=8, help="Most endpoint changes to make at once")
+def deploy_flow(service, dry_run, workers):
     """Deploy the latest flow, and track the id in cfde_client_config. Old flows
-    are not automatically deleted, and are tracked in old_flows_filename"""
+    are not automatically deleted, and are tracked in old_flows_filename. The flow
+    is deployed while the DCC directories and ACLs are provisioned."""
+    started = time.monotonic()
     flows_client = globus_automate_client.create_flows_client(native_app_id)
     serv = deriva_aps[service]
     client_config = load_client_config()
     full_submission_flow_def["definition"]["States"]["DerivaIngest"]["ActionUrl"] = serv
     deriva_server = CFDE_CONFIG['DEFAULT_SERVER_NAME']
 
-    admins = get_groups(deriva_server, 'admin')
-    submitters = get_groups(deriva_server, 'submitter')
-    reviewers = get_groups(deriva_server, 'reviewer')
-    approvers = get_groups(deriva_server, 'approver')
+    groups = get_all_groups(deriva_server)
+    click.echo(f"Fetched groups for {sum(len(g) for g in groups.values())} DCC roles "
+               f"({time.monotonic() - started:.1f}s)")
+    admins = groups['admin']
+    submitters = groups['submitter']
+    reviewers = groups['reviewer']
+    approvers = groups['approver']
 
     writers = [admins, submitters]
-    flow_runnable_urns = set_acls_from_groups(writers, "rw")
+    flow_runnable_urns, dirs, rules = get_desired_acls(writers, "rw")
 
     readers = [reviewers, approvers]
-    set_acls_from_groups(readers, "r")
+    _, reader_dirs, reader_rules = get_desired_acls(readers, "r")
+    dirs |= reader_dirs
+    for key, permissions in reader_rules.items():
+        rules[key] = merge_permissions(rules.get(key), permissions)
+
+    plan = plan_acls(dirs, rules)
+    click.echo(format_acl_plan(plan))
+    click.echo(f"Planned endpoint changes ({time.monotonic() - started:.1f}s)")
+    if dry_run:
+        return
 
     flow_runnable_urns = list(set(flow_runnable_urns))
-    full_flow_deploy_res = flows_client.deploy_flow(
-        flow_definition=full_submission_flow_def["definition"],
-        title=full_submission_flow_def["title"],
-        description=full_submission_flow_def["description"],
-        visible_to=flow_runnable_urns,
-        runnable_by=flow_runnable_urns,
-    )
-    click.secho(f"[{service}] Flow Deployed: {full_flow_deploy_res['id']}", fg="green")
+    flow_definition = get_compiled_definition()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        deploy_future = executor.submit(
+            flows_client.deploy_flow,
+            flow_definition=flow_definition,
+            title=full_submission_flow_def["title"],
+            description=full_submission_flow_def["description"],
+            visible_to=flow_runnable_urns,
+            runnable_by=flow_runnable_urns,
+        )
+        try:
+            apply_acl_plan(plan, executor)
+        finally:
+            # The flow is recorded even if endpoint changes failed, so it is never
+            # orphaned. The failed changes are reported once it is.
+            full_flow_deploy_res = deploy_future.result()
+            click.secho(f"[{service}] Flow Deployed: {full_flow_deploy_res['id']} "
+                        f"({time.monotonic() - started:.1f}s)", fg="green")
+            save_flow_id(service, client_config, full_flow_deploy_res["id"])
+
+    # Here we could check the current version of the CLI, and update the minimum requirement
+    "https://pypi.org/pypi/cfde-submit/json"
+
 
+def save_flow_id(service, client_config, flow_id):
+    """Track a newly deployed flow in old_flows_filename, and make it the service's
+    flow in cfde_client_config."""
     with open(old_flows_filename, mode='a') as f:
-        f.write(f"Replaced {datetime.datetime.now().isoformat()} -- "
-                f"{full_flow_deploy_res['id']}\n")
+        f.write(f"Replaced {datetime.datetime.now().isoformat()} -- {flow_id}\n")
 
-    client_config["FLOWS"][service]["flow_id"] = full_flow_deploy_res["id"]
+    client_config["FLOWS"][service]["flow_id"] = flow_id
 
     with open(client_config_filename, "w+") as f:
         f.write(json.dumps(client_config, indent=4))
     click.secho(f"Client Config Updated '{client_config_filename}'", fg="green")
 
-    # Here we could check the current version of the CLI, and update the minimum requirement
-    "https://pypi.org/pypi/cfde-submit/json"
-
 
 @cli.command(help="Update the existing flow ID for a service with new definition changes")
 @click.option("--service", default="dev")  # , hidden=True)
@@ -97,15 +131,29 @@ def update_flow(service):
     flow_id = client_config["FLOWS"][service]["flow_id"]
     full_submission_flow_def["definition"]["States"]["DerivaIngest"]["ActionUrl"] = serv
 
-
     flows_client.update_flow(
         flow_id,
-        full_submission_flow_def["definition"],
+        get_compiled_definition(),
     )
     click.secho(f'Updated flow {flow_id}', fg='green')
     click.secho('NOTE: No provisioning took place. If any dependent scopes were added to the flow, '
                 'this may result in any future flow instances failing', fg='yellow')
 
+
+@cli.command(help="Show the critical path of the flow before and after compiling")
+def flow_report():
+    get_compiled_definition()
+
+
+def get_compiled_definition():
+    """Compile the flow definition in flow.py, replacing its expression_eval
+    actions with Pass states, and show the hops saved."""
+    definition = full_submission_flow_def["definition"]
+    compiled = compile_flow(definition)
+    click.secho(format_report(definition, compiled), fg="blue")
+    return compiled
+
+
 @cli.command(help="Deploy client-config for public usage")
 def deploy_client_config():
     cli = fair_research_login.NativeClient(client_id=native_app_id)
@@ -148,62 +196,169 @@ def get_remote_config():
     return resp.json()
 
 
-def get_groups(servername, role):
+def get_all_groups(servername):
+    """Return the groups of every DCC for every role, from one registry query,
+    keyed by role name, e.g. 'admin'."""
     credentials = {
         "bearer-token": nc.load_tokens_by_scope()[DERIVA_SCOPE]['access_token']
     }
     registry = Registry('https', servername, credentials=credentials)
-    groups = registry.get_groups_by_dcc_role(role_id=f'cfde_registry_grp_role:{role}')
+    groups = collections.defaultdict(list)
+    for dcc_role in registry.get_groups_by_dcc_role():
+        groups[dcc_role['role'].split(':')[-1]].append(dcc_role)
     return groups
 
 
-def create_dir(path):
-    try:
-        transfer_client.operation_ls(CFDE_CONFIG["GCS_ENDPOINT"], path=path)
-    except globus_sdk.exc.TransferAPIError as tapie:
-        if tapie.code != "ClientError.NotFound":
-            raise
-        transfer_client.operation_mkdir(CFDE_CONFIG["GCS_ENDPOINT"], path=path)
-
-
-def create_acl(path, group, permissions):
-    endpoint = CFDE_CONFIG['GCS_ENDPOINT']
-    existing_rules = transfer_client.endpoint_acl_list(endpoint)
+def get_transfer_client():
+    if not hasattr(transfer_clients, "client"):
+        transfer_clients.client = globus_sdk.TransferClient(authorizer=auth)
+    return transfer_clients.client
 
-    rule = {'DATA_TYPE': 'access',
-            'path': path,
-            'permissions': permissions,
-            'principal': group,
-            'principal_type': 'group',
-            'role_id': None,
-            'role_type': None}
 
-    for existing_rule in existing_rules:
-        existing_rule.pop("id")
-        existing_rule.pop("permissions")
-        rule_copy = copy.deepcopy(rule)
-        rule_copy.pop("permissions")
-        if existing_rule == rule_copy:
-            return
+def merge_permissions(*permissions):
+    """Return the union of ACL permissions, e.g. "rw" for "r" and "rw"."""
+    merged = set("".join(p for p in permissions if p))
+    return "".join(p for p in "rw" if p in merged)
 
-    return transfer_client.add_endpoint_acl_rule(endpoint, rule)
 
+def get_desired_acls(group_lists, cfde_data_permissions):
+    """Return the group URNs, DCC directories and ACL rules the groups need. Each
+    group can read its DCC's directory, and has cfde_data_permissions on /CFDE/data/.
 
-def set_acls_from_groups(group_lists, cfde_data_permissions):
+    Returns:
+        tuple: The group URNs (list), the DCC directory paths (set), and the ACL
+            permissions keyed by (path, group ID) (dict).
+    """
     urns = list()
+    dirs = set()
+    rules = dict()
     for group_list in group_lists:
         for dcc_dict in group_list:
             dcc = dcc_dict['dcc']
             dcc_name = dcc.split(':')[-1]
+            group_dir = os.path.join(CFDE_CONFIG["LONG_TERM_STORAGE"], dcc_name) + "/"
+            dirs.add(group_dir)
             for group in dcc_dict['groups']:
                 gid = group['id']
-                urn = f"urn:globus:groups:id:{gid}"
-                urns.append(urn)
-                group_dir = os.path.join(CFDE_CONFIG["LONG_TERM_STORAGE"], dcc_name) + "/"
-                create_dir(group_dir)
-                create_acl(group_dir, gid, "r")
-                create_acl("/CFDE/data/", gid, cfde_data_permissions)
-    return urns
+                urns.append(f"urn:globus:groups:id:{gid}")
+                rules[(group_dir, gid)] = merge_permissions(rules.get((group_dir, gid)), "r")
+                rules[("/CFDE/data/", gid)] = merge_permissions(rules.get(("/CFDE/data/", gid)),
+                                                                cfde_data_permissions)
+    return urns, dirs, rules
+
+
+def get_existing_dirs(parent):
+    """Return the paths of the directories in parent on the GCS endpoint, from one
+    listing."""
+    try:
+        listing = get_transfer_client().operation_ls(CFDE_CONFIG["GCS_ENDPOINT"], path=parent)
+    except globus_sdk.exc.TransferAPIError as tapie:
+        if tapie.code != "ClientError.NotFound":
+            raise
+        return set()
+    return {os.path.join(parent, entry["name"]) + "/" for entry in listing
+            if entry["type"] == "dir"}
+
+
+def get_acl_index(endpoint):
+    """Return the endpoint's group ACL rules, from one listing, keyed by
+    (path, group ID)."""
+    return {(rule["path"], rule["principal"]): rule
+            for rule in get_transfer_client().endpoint_acl_list(endpoint)
+            if rule["principal_type"] == "group"}
+
+
+def plan_acls(dirs, rules):
+    """Compare the directories and ACL rules wanted on the GCS endpoint with those
+    it has, and return the changes needed. Rules which are not wanted are left in
+    place, as the endpoint has rules not managed here.
+
+    Arguments:
+        dirs (set): The directory paths wanted.
+        rules (dict): The ACL permissions wanted, keyed by (path, group ID).
+
+    Returns:
+        dict: The plan, with:
+            mkdir (list of str): The directories to create.
+            add (list of dict): The ACL rules to add.
+            update (list of tuple): The (rule ID, old permissions, new rule) of
+                    each ACL rule whose permissions must change.
+    """
+    existing_dirs = set()
+    for parent in {os.path.dirname(d.rstrip("/")) for d in dirs}:
+        existing_dirs |= get_existing_dirs(parent)
+    acl_index = get_acl_index(CFDE_CONFIG["GCS_ENDPOINT"])
+
+    plan = {"mkdir": sorted(dirs - existing_dirs), "add": [], "update": []}
+    for (path, gid), permissions in sorted(rules.items()):
+        rule = {'DATA_TYPE': 'access',
+                'path': path,
+                'permissions': permissions,
+                'principal': gid,
+                'principal_type': 'group'}
+        existing_rule = acl_index.get((path, gid))
+        if existing_rule is None:
+            plan["add"].append(rule)
+        elif existing_rule["permissions"] != permissions:
+            plan["update"].append((existing_rule["id"], existing_rule["permissions"], rule))
+    return plan
+
+
+def format_acl_plan(plan):
+    lines = [f"Directories to create: {len(plan['mkdir'])}, ACL rules to add: "
+             f"{len(plan['add'])}, ACL rules to update: {len(plan['update'])}"]
+    lines.extend(f"  mkdir  {path}" for path in plan["mkdir"])
+    lines.extend(f"  add    {rule['path']} {rule['principal']} {rule['permissions']}"
+                 for rule in plan["add"])
+    lines.extend(f"  update {rule['path']} {rule['principal']} {old} -> {rule['permissions']}"
+                 for _, old, rule in plan["update"])
+    return "\n".join(lines)
+
+
+def apply_changes(changes):
+    """Make a list of endpoint changes, in order."""
+    tc = get_transfer_client()
+    endpoint = CFDE_CONFIG['GCS_ENDPOINT']
+    for change in changes:
+        if change[0] == "mkdir":
+            tc.operation_mkdir(endpoint, path=change[1])
+        elif change[0] == "add":
+            tc.add_endpoint_acl_rule(endpoint, change[1])
+        else:
+            tc.update_endpoint_acl_rule(
+                endpoint, change[1], {'DATA_TYPE': 'access', 'permissions': change[2]})
+
+
+def apply_acl_plan(plan, executor):
+    """Apply a plan from plan_acls() with an executor, showing progress. Each new
+    DCC directory is created along with its ACL rules, and every other rule is
+    applied on its own, so changes for different DCCs are made at once.
+
+    Raises click.ClickException after all changes are tried, if any failed.
+    """
+    tasks = {path: [("mkdir", path)] for path in plan["mkdir"]}
+    for rule in plan["add"]:
+        if rule["path"] in tasks:
+            tasks[rule["path"]].append(("add", rule))
+        else:
+            tasks[f"{rule['path']} {rule['principal']}"] = [("add", rule)]
+    for rule_id, _, rule in plan["update"]:
+        tasks[f"{rule['path']} {rule['principal']}"] = [("update", rule_id, rule["permissions"])]
+
+    started = time.monotonic()
+    futures = {executor.submit(apply_changes, changes): name for name, changes in tasks.items()}
+    failures = 0
+    for done, future in enumerate(as_completed(futures), start=1):
+        try:
+            future.result()
+        except Exception as e:
+            failures += 1
+            click.secho(f"[{done}/{len(futures)}] {futures[future]} failed: {e}", fg="red")
+        else:
+            click.echo(f"[{done}/{len(futures)}] {futures[future]} "
+                       f"({time.monotonic() - started:.1f}s)")
+    if failures:
+        raise click.ClickException(f"{failures} of {len(futures)} endpoint changes failed")
 
 
 if __name__ == "__main__":
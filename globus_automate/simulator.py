@@ -0,0 +1,405 @@
+"""Simulate a run of a flow definition locally, to benchmark its latency offline.
+
+The simulator interprets the states used by our flows (Action, Choice and Pass,
+with Parameters, ResultPath and Catch) against local stand-ins for the action
+providers, on a simulated clock. Each Action state costs a round trip to submit,
+then is polled as Globus Flows does, every poll_interval seconds doubling up to
+max_poll_interval, until the action's simulated duration has passed. Every state
+also costs a transition overhead in the Flows service. Run with --help for the
+latencies which can be set. For example, to compare the flow in flow.py with its
+compiled form (see compiler.py):
+
+    python simulator.py --compare --transfer-duration 60 --ingest-duration 300
+
+The DerivaIngest state can instead be run against the AP's own Flask app with
+--flask-app, given a token the AP accepts. It then runs in real time, and needs
+the AP's config and services, as for a local server.
+"""
+import copy
+import itertools
+import time
+
+import click
+
+from compiler import EXPRESSION_EVAL_URL, compile_flow
+
+TRANSFER_URL = "https://actions.automate.globus.org/transfer/transfer"
+NOTIFY_URL = "https://actions.globus.org/notification/notify"
+AP_URL = "http://localhost:5000/"
+
+DEFAULT_INPUT = {
+    "source_endpoint_id": "a5a3e2ec-5d42-4fe6-94b8-0b8c1e39a9b4",
+    "source_path": "/submissions/datapackage.zip",
+    "cfde_ep_id": "36530efa-a1e3-45dc-a6e7-9560a8e9ac49",
+    "cfde_ep_path": "/CFDE/data/datapackage.zip",
+    "cfde_ep_url": "https://g-c7e94.f19a4.5898.data.globus.org",
+    "is_directory": False,
+    "dcc_id": "cfde_registry_dcc:kidsfirst",
+    "test_sub": False
+}
+
+
+class FlowError(Exception):
+    """A state failed, with a States Language error name, e.g. States.Runtime."""
+    def __init__(self, error, cause):
+        super().__init__(f"{error}: {cause}")
+        self.error = error
+        self.cause = cause
+
+
+class _Names(dict):
+    """A dict whose keys can also be read as attributes, so expressions can use
+    dotted names for nested values, as in Globus Flows."""
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def _to_names(value):
+    if isinstance(value, dict):
+        return _Names({k: _to_names(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_to_names(v) for v in value]
+    return value
+
+
+def evaluate(expression, names):
+    """Evaluate a flow expression with the given names. Only trusted flow
+    definitions should be simulated, as this uses eval()."""
+    namespace = {"__builtins__": {"str": str, "int": int, "float": float, "len": len}}
+    namespace.update(_to_names(names))
+    try:
+        return eval(expression, namespace)
+    except Exception as e:
+        raise FlowError("States.Runtime", f"Could not evaluate '{expression}': {e!r}")
+
+
+def get_path(document, path):
+    """Return the value at a JSONPath of the form $.a.b in document."""
+    if not path.startswith("$"):
+        raise FlowError("States.Runtime", f"Invalid JSONPath '{path}'")
+    value = document
+    for key in filter(None, path[1:].split(".")):
+        if not isinstance(value, dict) or key not in value:
+            raise FlowError("States.Runtime", f"'{path}' not found in state input")
+        value = value[key]
+    return value
+
+
+def set_path(document, path, value):
+    """Return a copy of document with the value set at a JSONPath of the form $.a.b."""
+    keys = list(filter(None, path[1:].split(".")))
+    if not keys:
+        return value
+    document = copy.deepcopy(document)
+    target = document
+    for key in keys[:-1]:
+        target = target.setdefault(key, {})
+    target[keys[-1]] = value
+    return document
+
+
+def resolve_parameters(parameters, document):
+    """Return the parameters with each .$ key resolved from document, and each .= key
+    evaluated against it."""
+    if isinstance(parameters, list):
+        return [resolve_parameters(value, document) for value in parameters]
+    if not isinstance(parameters, dict):
+        return parameters
+    resolved = {}
+    for key, value in parameters.items():
+        if key.endswith(".$"):
+            resolved[key[:-2]] = get_path(document, value)
+        elif key.endswith(".="):
+            resolved[key[:-2]] = evaluate(value, document)
+        else:
+            resolved[key] = resolve_parameters(value, document)
+    return resolved
+
+
+class StandInProvider:
+    """A local action provider, whose actions finish after a simulated duration.
+
+    Arguments:
+        duration (float): The seconds each action takes. Default 0.
+        details (callable): Returns the details of a finished action, given its
+                request body. Default None for empty details.
+        fail (bool): True if actions fail. Default False.
+    """
+    real_time = False
+
+    def __init__(self, duration=0, details=None, fail=False):
+        self.duration = duration
+        self.details = details or (lambda body: {})
+        self.fail = fail
+        self.actions = {}
+        self.ids = itertools.count()
+
+    def _get_status(self, action_id, now):
+        body, started = self.actions[action_id]
+        if now - started < self.duration:
+            return {"action_id": action_id, "status": "ACTIVE", "details": {}}
+        return {
+            "action_id": action_id,
+            "status": "FAILED" if self.fail else "SUCCEEDED",
+            "details": self.details(body)
+        }
+
+    def run(self, body, now):
+        action_id = str(next(self.ids))
+        self.actions[action_id] = (body, now)
+        return self._get_status(action_id, now)
+
+    def status(self, action_id, now):
+        return self._get_status(action_id, now)
+
+    def wait(self, seconds):
+        pass
+
+
+class FlaskActionProvider:
+    """Run actions against a Flask Action Provider app, through its test client,
+    in real time."""
+    real_time = True
+
+    def __init__(self, app, token):
+        self.client = app.test_client()
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def _check(self, res):
+        if res.status_code >= 300:
+            raise FlowError("ActionFailedException", res.get_data(as_text=True))
+        return res.get_json()
+
+    def run(self, body, now):
+        return self._check(self.client.post("/run", json={"body": body},
+                                            headers=self.headers))
+
+    def status(self, action_id, now):
+        return self._check(self.client.get(f"/{action_id}/status", headers=self.headers))
+
+    def wait(self, seconds):
+        time.sleep(seconds)
+
+
+def _evaluate_expressions(body):
+    return {expression["result_path"]: evaluate(expression["expression"],
+                                                expression.get("arguments", {}))
+            for expression in body["expressions"]}
+
+
+def get_stand_ins(transfer_duration=0, ingest_duration=0, notify_duration=0,
+                  expression_duration=0, fail_ingest=False):
+    """Return stand-in providers for the actions in our flows, keyed by ActionUrl."""
+    def ingest_details(body):
+        if fail_ingest:
+            return {"error": "Simulated ingest failure", "submission_id": "1-ABCD"}
+        return {
+            "error": False,
+            "submission_id": "1-ABCD",
+            "submission_link": "https://app.nih-cfde.org/submissions/1-ABCD"
+        }
+    return {
+        TRANSFER_URL: StandInProvider(transfer_duration,
+                                      lambda body: {"task_id": "simulated-task"}),
+        EXPRESSION_EVAL_URL: StandInProvider(expression_duration, _evaluate_expressions),
+        NOTIFY_URL: StandInProvider(notify_duration),
+        AP_URL: StandInProvider(ingest_duration, ingest_details)
+    }
+
+
+class FlowSimulator:
+    """Run flow definitions against action providers on a simulated clock.
+
+    Arguments:
+        providers (dict): The action providers, keyed by ActionUrl.
+        round_trip (float): The seconds for each request to an action provider.
+        transition (float): The seconds the Flows service takes to start each state.
+        poll_interval (float): The seconds before an action's status is first polled.
+        max_poll_interval (float): The most seconds between polls.
+    """
+    def __init__(self, providers, round_trip=0.2, transition=0.5, poll_interval=1,
+                 max_poll_interval=60):
+        self.providers = providers
+        self.round_trip = round_trip
+        self.transition = transition
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.clock = 0
+        self.polls = 0
+
+    def _request(self, provider, call, *args):
+        started = time.monotonic()
+        self.clock += self.round_trip
+        result = call(*args, self.clock)
+        if provider.real_time:
+            self.clock += time.monotonic() - started
+        return result
+
+    def _run_action(self, state, document):
+        """Run an Action state, returning its result. The polls made are counted in
+        self.polls."""
+        provider = self.providers.get(state["ActionUrl"])
+        if provider is None:
+            raise FlowError("States.Runtime", f"No provider for '{state['ActionUrl']}'")
+        body = resolve_parameters(state.get("Parameters", {}), document)
+        started = self.clock
+        status = self._request(provider, provider.run, body)
+        interval = self.poll_interval
+        while status["status"] not in ("SUCCEEDED", "FAILED"):
+            if self.clock - started >= state.get("WaitTime", 300):
+                raise FlowError("ActionTimeout", f"Action did not finish within "
+                                                 f"{state.get('WaitTime', 300)} seconds")
+            provider.wait(interval)
+            self.clock += interval
+            interval = min(interval * 2, self.max_poll_interval)
+            status = self._request(provider, provider.status, status["action_id"])
+            self.polls += 1
+        if status["status"] == "FAILED" and state.get("ExceptionOnActionFailure"):
+            raise FlowError("ActionFailedException", status.get("details"))
+        return status
+
+    def _choose(self, rule, document):
+        if "And" in rule:
+            return all(self._choose(r, document) for r in rule["And"])
+        if "Or" in rule:
+            return any(self._choose(r, document) for r in rule["Or"])
+        if "Not" in rule:
+            return not self._choose(rule["Not"], document)
+        try:
+            value = get_path(document, rule["Variable"])
+        except FlowError:
+            return rule.get("IsPresent") is False
+        for test in ("BooleanEquals", "StringEquals", "NumericEquals"):
+            if test in rule:
+                return value == rule[test]
+        if "IsPresent" in rule:
+            return rule["IsPresent"]
+        raise FlowError("States.Runtime", f"Unsupported Choice rule {rule}")
+
+    def run(self, definition, flow_input, context=None):
+        """Run a flow definition to its end.
+
+        Arguments:
+            definition (dict): The flow definition, with StartAt and States.
+            flow_input (dict): The input to the flow.
+            context (dict): The _context of the run. Default None for a placeholder.
+
+        Returns:
+            dict: The run's report, with:
+                status (str): SUCCEEDED, or FAILED if an error was not caught.
+                total (float): The seconds the run took.
+                states (list of dict): Each state run, in order, with its name,
+                        type, seconds and polls.
+                output (dict): The final document, or the error if FAILED.
+        """
+        self.clock = 0
+        context = context or {"action_id": "simulated-run", "email": "user@example.org"}
+        document = dict(flow_input, _context=context)
+        states = []
+        name = definition["StartAt"]
+        status = "SUCCEEDED"
+        while name is not None:
+            state = definition["States"][name]
+            started = self.clock
+            self.clock += self.transition
+            self.polls = 0
+            next_name = None
+            try:
+                if state["Type"] == "Action":
+                    result = self._run_action(state, document)
+                    document = set_path(document, state.get("ResultPath", "$"), result)
+                elif state["Type"] == "Pass":
+                    result = resolve_parameters(state.get("Parameters", {}), document)
+                    if "Parameters" in state:
+                        document = set_path(document, state.get("ResultPath", "$"), result)
+                elif state["Type"] == "Choice":
+                    next_name = next((choice["Next"] for choice in state["Choices"]
+                                      if self._choose(choice, document)),
+                                     state.get("Default"))
+                    if next_name is None:
+                        raise FlowError("States.NoChoiceMatched", name)
+                else:
+                    raise FlowError("States.Runtime", f"Unsupported state type {state['Type']}")
+                if next_name is None and not state.get("End"):
+                    next_name = state["Next"]
+            except FlowError as e:
+                catch = next((c for c in state.get("Catch", [])
+                              if "States.ALL" in c["ErrorEquals"] or e.error in c["ErrorEquals"]),
+                             None)
+                if catch is None:
+                    states.append({"name": name, "type": state["Type"],
+                                   "seconds": self.clock - started, "polls": self.polls})
+                    status = "FAILED"
+                    document = {"error": e.error, "cause": e.cause, "state": name}
+                    break
+                error_output = {"Error": e.error, "Cause": e.cause}
+                document = set_path(document, catch.get("ResultPath", "$"), error_output)
+                document["_context"] = context
+                next_name = catch["Next"]
+            states.append({"name": name, "type": state["Type"],
+                           "seconds": self.clock - started, "polls": self.polls})
+            name = next_name
+        return {
+            "status": status,
+            "total": self.clock,
+            "states": states,
+            "output": document
+        }
+
+
+def format_report(title, report):
+    lines = [f"{title}: {report['status']} in {report['total']:.1f}s",
+             f"    {'State':<24}{'Type':<8}{'Seconds':>10}{'Polls':>7}"]
+    for state in report["states"]:
+        lines.append(f"    {state['name']:<24}{state['type']:<8}"
+                     f"{state['seconds']:>10.1f}{state['polls']:>7}")
+    if report["status"] == "FAILED":
+        lines.append(f"    Error: {report['output']['error']}: {report['output']['cause']}")
+    return "\n".join(lines)
+
+
+@click.command(help="Simulate a run of the flow in flow.py and report its latency")
+@click.option("--round-trip", default=0.2, help="Seconds per request to an action provider")
+@click.option("--transition", default=0.5, help="Seconds of Flows overhead per state")
+@click.option("--poll-interval", default=1.0, help="Seconds before the first status poll")
+@click.option("--max-poll-interval", default=60.0, help="Most seconds between status polls")
+@click.option("--transfer-duration", default=30.0, help="Seconds a transfer takes")
+@click.option("--ingest-duration", default=120.0, help="Seconds an ingest takes")
+@click.option("--notify-duration", default=1.0, help="Seconds a notification takes")
+@click.option("--expression-duration", default=0.0, help="Seconds an expression_eval takes")
+@click.option("--no-transfer", is_flag=True, help="Submit data already on the GCS endpoint")
+@click.option("--test-sub", is_flag=True, help="Submit a test submission")
+@click.option("--fail-ingest", is_flag=True, help="Make the ingest fail")
+@click.option("--compare", is_flag=True, help="Also run the compiled flow")
+@click.option("--flask-app", is_flag=True, help="Run DerivaIngest against cfde_ap.api")
+@click.option("--token", default="", help="Bearer token for --flask-app")
+def main(round_trip, transition, poll_interval, max_poll_interval, transfer_duration,
+         ingest_duration, notify_duration, expression_duration, no_transfer, test_sub,
+         fail_ingest, compare, flask_app, token):
+    from flow import full_submission_flow_def
+    definition = copy.deepcopy(full_submission_flow_def["definition"])
+    definition["States"]["DerivaIngest"]["ActionUrl"] = AP_URL
+    flow_input = dict(DEFAULT_INPUT, test_sub=test_sub)
+    if no_transfer:
+        flow_input["source_endpoint_id"] = False
+        flow_input["data_url"] = flow_input["cfde_ep_url"] + flow_input["cfde_ep_path"]
+
+    runs = [("Flow", definition)]
+    if compare:
+        runs.append(("Compiled flow", compile_flow(definition)))
+    for title, run_definition in runs:
+        providers = get_stand_ins(transfer_duration, ingest_duration, notify_duration,
+                                  expression_duration, fail_ingest)
+        if flask_app:
+            from cfde_ap.api import app
+            providers[AP_URL] = FlaskActionProvider(app, token)
+        simulator = FlowSimulator(providers, round_trip, transition, poll_interval,
+                                  max_poll_interval)
+        click.echo(format_report(title, simulator.run(run_definition, flow_input)))
+
+
+if __name__ == "__main__":
+    main()
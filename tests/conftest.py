@@ -0,0 +1,21 @@
+import os
+import tempfile
+
+import pytest
+
+# cfde_ap reads its config on import, with DATA_DIR under the home directory, which
+# must exist. Tests use a home of their own, and the dev config.
+os.environ.setdefault("FLASK_ENV", "dev")
+os.environ["HOME"] = tempfile.mkdtemp(prefix="cfde_ap_tests_")
+os.makedirs(os.path.join(os.environ["HOME"], "deriva_data"))
+
+from cfde_ap import CONFIG  # noqa: E402
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    """Point every directory the AP writes to into tmp_path, and return CONFIG."""
+    for key in ("DATA_DIR", "ARCHIVE_CACHE_DIR", "CHECKPOINT_DIR", "SCHEDULER_DIR",
+                "ACTION_LOG_DIR"):
+        monkeypatch.setitem(CONFIG, key, str(tmp_path / key.lower()))
+    return CONFIG
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from cfde_ap import archives, validation
+
+
+def add_object(name, size, mtime):
+    path = os.path.join(archives._get_cache_dir("objects"), name)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+@pytest.fixture
+def cache(config, monkeypatch):
+    monkeypatch.setitem(config, "ARCHIVE_CACHE_MAX_BYTES", 25)
+    return config
+
+
+def test_evict_least_recently_used_first(cache):
+    add_object("a", 10, 1)
+    add_object("b", 10, 2)
+    add_object("c", 10, 3)
+    archives.evict_archives()
+    assert sorted(os.listdir(archives._get_cache_dir("objects"))) == ["b", "c"]
+
+
+def test_evict_skips_kept_and_pinned(cache):
+    add_object("a", 10, 1)
+    add_object("b", 10, 2)
+    add_object("c", 10, 3)
+    archives._pin("a", "action-1")
+    archives.evict_archives(keep="b")
+    assert sorted(os.listdir(archives._get_cache_dir("objects"))) == ["a", "b"]
+
+    archives.unpin_archives("action-1")
+    add_object("d", 10, 4)
+    archives.evict_archives(keep="b")
+    assert sorted(os.listdir(archives._get_cache_dir("objects"))) == ["b", "d"]
+
+
+def test_unpin_only_removes_own_pins(cache):
+    archives._pin("a", "action-1")
+    archives._pin("a", "action-2")
+    archives.unpin_archives("action-1")
+    assert os.listdir(archives._get_cache_dir("pins")) == ["a.action-2"]
+
+
+def test_get_cache_size(cache):
+    assert archives.get_cache_size() == 0
+    add_object("a", 10, 1)
+    add_object("b", 5, 2)
+    assert archives.get_cache_size() == 15
+
+
+def test_fetch_archive_by_known_digest(cache, monkeypatch):
+    path = add_object("d" * 64, 10, 1)
+    monkeypatch.setattr(archives.transfer, "get_local_path", lambda url: None)
+    monkeypatch.setattr(archives, "_get_source_key", lambda url, headers: "moved")
+
+    def no_download(url, headers, pin=None):
+        raise AssertionError("archive was downloaded again")
+    monkeypatch.setattr(archives, "_download", no_download)
+
+    assert archives.fetch_archive("https://example.org/moved.tgz", digest="d" * 64,
+                                  pin="action-1") == (path, "d" * 64)
+    # The moved url now finds the archive by itself, and it is pinned
+    assert archives._read_key("moved") == "d" * 64
+    assert os.listdir(archives._get_cache_dir("pins")) == ["d" * 64 + ".action-1"]
+
+
+def test_verify_checksum():
+    archives.verify_checksum("abc", "SHA256:ABC")
+    with pytest.raises(validation.ArchiveValidationError):
+        archives.verify_checksum("abc", "abd")
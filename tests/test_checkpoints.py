@@ -0,0 +1,55 @@
+import os
+import stat
+
+import pytest
+
+from cfde_ap import checkpoints, ingest
+
+URL = "https://example.org/CFDE/data/dcc/bag.tgz"
+MOVED = {"url": "https://example.org/CFDE/public/dcc/moved.tgz"}
+
+
+@pytest.fixture
+def failed(config):
+    checkpoint = checkpoints.start_checkpoint("failed-action", {"url": URL, "dcc_id": "dcc"})
+    checkpoints.record_phase(checkpoint, "moved", MOVED)
+    checkpoints.record_phase(checkpoint, "downloaded", {"archive_digest": "abc"})
+    checkpoints.record_phase(checkpoint, "failed")
+    return checkpoint
+
+
+def test_checkpoint_readable_only_by_owner(config):
+    checkpoints.start_checkpoint("action", {"url": URL})
+    mode = os.stat(checkpoints._get_checkpoint_path("action")).st_mode
+    assert stat.S_IMODE(mode) == 0o600
+
+
+def test_adopt_when_data_url_is_gone(failed, monkeypatch):
+    monkeypatch.setattr(ingest.transfer, "file_exists", lambda url: False)
+    checkpoint = checkpoints.start_checkpoint("action", {"url": URL, "dcc_id": "dcc"})
+    ingest.adopt_failed_checkpoint(checkpoint, URL, "dcc", checksum="sha256:abc")
+    assert checkpoints.get_phase(checkpoint, "moved") == MOVED
+    assert checkpoints.get_phase(checkpoint, "downloaded") == {"archive_digest": "abc"}
+    assert checkpoints.load_checkpoint("failed-action") is None
+
+
+def test_no_adoption_when_data_url_uploaded_again(failed, monkeypatch):
+    monkeypatch.setattr(ingest.transfer, "file_exists", lambda url: True)
+    checkpoint = checkpoints.start_checkpoint("action", {"url": URL, "dcc_id": "dcc"})
+    ingest.adopt_failed_checkpoint(checkpoint, URL, "dcc")
+    assert checkpoint["phases"] == {}
+    assert checkpoints.load_checkpoint("failed-action") is not None
+
+
+def test_no_adoption_on_checksum_mismatch(failed, monkeypatch):
+    monkeypatch.setattr(ingest.transfer, "file_exists", lambda url: False)
+    checkpoint = checkpoints.start_checkpoint("action", {"url": URL, "dcc_id": "dcc"})
+    ingest.adopt_failed_checkpoint(checkpoint, URL, "dcc", checksum="def")
+    assert checkpoint["phases"] == {}
+
+
+def test_no_adoption_for_other_dcc(failed, monkeypatch):
+    monkeypatch.setattr(ingest.transfer, "file_exists", lambda url: False)
+    checkpoint = checkpoints.start_checkpoint("action", {"url": URL, "dcc_id": "other"})
+    ingest.adopt_failed_checkpoint(checkpoint, URL, "other")
+    assert checkpoint["phases"] == {}
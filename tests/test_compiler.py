@@ -0,0 +1,74 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "globus_automate"))
+
+import compiler  # noqa: E402
+
+CATCH = [{"ErrorEquals": ["States.ALL"], "Next": "ErrorState"}]
+
+
+def expression_state(expressions, **fields):
+    state = {
+        "Type": "Action",
+        "ActionUrl": compiler.EXPRESSION_EVAL_URL,
+        "Parameters": {"expressions": expressions},
+        "ResultPath": "$.Result",
+        "Next": "Done"
+    }
+    state.update(fields)
+    return state
+
+
+def test_compile_path_and_literal():
+    state = expression_state([
+        {"expression": "data_url", "arguments": {"data_url.$": "$.data_url"},
+         "result_path": "data_url"},
+        {"expression": "'done'", "result_path": "message"}
+    ], Catch=CATCH)
+    assert compiler.compile_state(state) == {
+        "Type": "Pass",
+        "Parameters": {"details": {"data_url.$": "$.data_url", "message": "done"}},
+        "ResultPath": "$.Result",
+        "Next": "Done"
+    }
+
+
+def test_compile_expression():
+    state = expression_state([
+        {"expression": "base_url + dest_path",
+         "arguments": {"base_url.$": "$.cfde_ep_url", "dest_path.$": "$.cfde_ep_path"},
+         "result_path": "data_url"}
+    ])
+    assert compiler.compile_state(state)["Parameters"]["details"] == {
+        "data_url.=": "cfde_ep_url + cfde_ep_path"}
+
+
+def test_expression_with_catch_is_not_compiled():
+    # str() of an error which is not a string can fail, and must reach the Catch
+    state = expression_state([
+        {"expression": "'Failed: ' + str(error)", "arguments": {"error.$": "$.error"},
+         "result_path": "error"}
+    ], Catch=CATCH)
+    assert compiler.compile_state(state) is None
+
+
+def test_argument_not_a_simple_path_is_not_compiled():
+    state = expression_state([
+        {"expression": "a + 'x'", "arguments": {"a.$": "$.list[0]"}, "result_path": "a"}
+    ])
+    assert compiler.compile_state(state) is None
+
+
+def test_critical_path_ignores_catch():
+    definition = {
+        "StartAt": "A",
+        "States": {
+            "A": {"Type": "Action", "Next": "B", "Catch": CATCH},
+            "B": {"Type": "Action", "End": True},
+            "ErrorState": {"Type": "Action", "Next": "ErrorLog"},
+            "ErrorLog": {"Type": "Action", "Next": "Notify"},
+            "Notify": {"Type": "Action", "End": True}
+        }
+    }
+    assert compiler.critical_path(definition) == ["A", "B"]
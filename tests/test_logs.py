@@ -0,0 +1,81 @@
+import logging
+
+import pytest
+
+from cfde_ap import logs
+
+logger = logging.getLogger("cfde_ap.test")
+
+
+@pytest.fixture
+def log_config(config, monkeypatch):
+    monkeypatch.setitem(config, "ACTION_LOG_MAX_BYTES", 1000)
+    monkeypatch.setattr(logging.getLogger("cfde_ap"), "level", logging.DEBUG)
+    return config
+
+
+@pytest.fixture
+def action_log(log_config):
+    handler = logs.capture_action_log("action")
+    yield handler
+    logs.release_action_log(handler)
+
+
+def numbers(page):
+    return [int(line.rsplit(" ", 1)[1]) for line in page["entries"]]
+
+
+def test_polling_across_rotations(action_log):
+    read = []
+    for i in range(200):
+        logger.info(f"line {i}")
+        if i % 7 == 0:
+            while True:
+                page = logs.read_action_log("action", offset=len(read), limit=3)
+                assert page["offset"] == len(read)
+                read += numbers(page)
+                if not page["has_next_page"]:
+                    break
+    # Every line was read once, in order, though the log rotated many times
+    assert read == list(range(197))
+
+
+def test_rotated_lines_are_skipped(action_log):
+    for i in range(100):
+        logger.info(f"line {i}")
+    page = logs.read_action_log("action", offset=0, limit=1000)
+    assert page["offset"] > 0
+    assert numbers(page) == list(range(page["offset"], 100))
+    assert numbers(logs.read_action_log("action", offset=98)) == [98, 99]
+
+
+def test_rotation_while_reading(action_log, monkeypatch):
+    for i in range(5):
+        logger.info(f"line {i}")
+    action_log.doRollover()
+    for i in range(5, 8):
+        logger.info(f"line {i}")
+
+    # Rotate after the newest file is opened, so the backup opened next is the same file
+    open_log_file = logs._open_log_file
+    rotated = []
+
+    def rotate_while_opening(path):
+        opened = open_log_file(path)
+        if not rotated:
+            rotated.append(path)
+            action_log.doRollover()
+        return opened
+    monkeypatch.setattr(logs, "_open_log_file", rotate_while_opening)
+    page = logs.read_action_log("action")
+    assert page["offset"] == 5 and numbers(page) == [5, 6, 7]
+
+
+def test_resumed_log_continues_numbering(log_config):
+    handler = logs.capture_action_log("action")
+    logger.info("line 0")
+    logs.release_action_log(handler)
+    handler = logs.capture_action_log("action")
+    logger.info("line 1")
+    logs.release_action_log(handler)
+    assert numbers(logs.read_action_log("action", offset=1)) == [1]
@@ -0,0 +1,97 @@
+import os
+import subprocess
+
+import pytest
+
+from cfde_ap import scheduler
+
+
+@pytest.fixture
+def sched(config, monkeypatch):
+    monkeypatch.setitem(config, "INGEST_DISK_BUDGET", 1000)
+    monkeypatch.setitem(config, "INGEST_DISK_USAGE_FACTOR", 1)
+    monkeypatch.setitem(config, "SMALL_INGEST_BYTES", 10)
+    monkeypatch.setitem(config, "MAX_CONCURRENT_INGESTS", 2)
+    monkeypatch.setitem(config, "TEST_INGEST_SLOTS", 1)
+    monkeypatch.setitem(config, "TEST_LANE_MAX_BYTES", 100)
+    monkeypatch.setitem(config, "TEST_LANE_DCCS", None)
+    monkeypatch.setitem(config, "DCC_WEIGHTS", {})
+    return config
+
+
+def job(action_id, size=100, dcc_id="dcc", test_sub=False, queued_at=0, **fields):
+    new = scheduler.new_job(action_id, {}, size, dcc_id=dcc_id, test_sub=test_sub)
+    new["queued_at"] = queued_at
+    new.update(fields)
+    return new
+
+
+def test_fits_disk_budget(sched):
+    running = [job("a", 600)]
+    assert scheduler._fits(job("b", 400), running)
+    assert not scheduler._fits(job("b", 401), running)
+    # Small ingests always fit, and so does anything on an idle host
+    assert scheduler._fits(job("b", 10), [job("a", 1000)])
+    assert scheduler._fits(job("b", 5000), [])
+
+
+def test_fits_unknown_size_needs_whole_budget(sched):
+    assert scheduler._fits(job("b", None), [])
+    assert not scheduler._fits(job("b", None), [job("a", 100)])
+
+
+def test_fits_slots_per_lane(sched):
+    running = [job("a", 1), job("b", 1)]
+    assert not scheduler._fits(job("c", 1), running)
+    # Test submissions have their own slots, and transfers take none yet
+    assert scheduler._fits(job("c", 1, test_sub=True), running)
+    assert scheduler._fits(job("c", 1, stage="transfer"), running)
+    assert scheduler._fits(job("c", 1), running[:1] + [job("b", 1, stage="transfer")])
+
+
+def test_fits_subtracts_archive_cache(sched, monkeypatch):
+    monkeypatch.setattr(scheduler.archives, "get_cache_size", lambda: 500)
+    assert not scheduler._fits(job("b", 400), [job("a", 200)])
+
+
+def test_fair_order(sched, monkeypatch):
+    queue = [job("x1", dcc_id="x", queued_at=1), job("x2", dcc_id="x", queued_at=2),
+             job("x3", dcc_id="x", queued_at=3), job("y1", dcc_id="y", queued_at=4),
+             job("t1", dcc_id="x", test_sub=True, queued_at=5)]
+    order = [j["action_id"] for j in scheduler._fair_order(queue, [])]
+    assert order == ["t1", "x1", "y1", "x2", "x3"]
+    # A DCC already running an ingest goes after the others
+    order = [j["action_id"] for j in scheduler._fair_order(queue, [job("r", dcc_id="x")])]
+    assert order == ["t1", "y1", "x1", "x2", "x3"]
+    # A DCC with twice the weight gets twice the turns
+    queue = [job(f"x{i}", dcc_id="x", queued_at=i) for i in range(1, 5)]
+    queue += [job("y1", dcc_id="y", queued_at=5), job("y2", dcc_id="y", queued_at=6)]
+    order = [j["action_id"] for j in scheduler._fair_order(queue, [])]
+    assert order == ["x1", "y1", "x2", "y2", "x3", "x4"]
+    monkeypatch.setitem(sched, "DCC_WEIGHTS", {"x": 2})
+    order = [j["action_id"] for j in scheduler._fair_order(queue, [])]
+    assert order == ["x1", "y1", "x2", "x3", "y2", "x4"]
+
+
+def test_may_use_test_lane(sched, monkeypatch):
+    assert scheduler._may_use_test_lane(100, "dcc")
+    assert not scheduler._may_use_test_lane(101, "dcc")
+    assert not scheduler._may_use_test_lane(None, "dcc")
+    monkeypatch.setitem(sched, "TEST_LANE_DCCS", ["other"])
+    assert not scheduler._may_use_test_lane(1, "dcc")
+    assert scheduler._may_use_test_lane(1, "other")
+    assert not job("a", 101, test_sub=True)["test_sub"]
+
+
+def test_claim_reclaims_dead_owner(sched):
+    scheduler.enqueue(job("a", 900))
+    claimed = scheduler.claim()
+    assert claimed["owner_pid"] == os.getpid()
+    scheduler.enqueue(job("b", 900, queued_at=1))
+    assert scheduler.claim() is None
+
+    dead = subprocess.Popen(["true"])
+    dead.wait()
+    scheduler.set_owner("a", dead.pid)
+    assert scheduler.claim()["action_id"] == "b"
+    assert [r["action_id"] for r in scheduler.list_running()] == ["b"]
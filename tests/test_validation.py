@@ -0,0 +1,99 @@
+import io
+import json
+import tarfile
+
+import numpy as np
+import pytest
+
+from cfde_ap import archives, validation
+
+
+def bad(values, field):
+    return validation._find_bad_values(np.array(values, dtype=object), field).tolist()
+
+
+def test_integer():
+    assert bad(["1", "-2", "+3", "1.0", "x", "1e3"], {"type": "integer"}) == [
+        False, False, False, True, True, True]
+
+
+def test_number():
+    assert bad(["1", "2.5", "-1e3"], {"type": "number"}) == [False, False, False]
+    assert bad(["1", "abc"], {"type": "number"}) == [False, True]
+
+
+def test_boolean():
+    assert bad(["true", "0", "yes"], {"type": "boolean"}) == [False, False, True]
+    assert bad(["yes", "no"], {"type": "boolean", "trueValues": ["yes"],
+                               "falseValues": ["no"]}) == [False, False]
+
+
+def test_date_default_format_needs_full_date():
+    assert bad(["2020-01-02", "2020", "2020-01", "NaT", "2020-02-30", "20200102"],
+               {"type": "date"}) == [False, True, True, True, True, True]
+
+
+def test_date_formats():
+    assert bad(["01/02/2020", "2020-01-02"], {"type": "date", "format": "%m/%d/%Y"}) == [
+        False, True]
+    assert bad(["anything"], {"type": "date", "format": "any"}) == [False]
+
+
+def test_enum():
+    assert bad(["a", "c"], {"constraints": {"enum": ["a", "b"]}}) == [False, True]
+
+
+def test_hash_keys():
+    a = np.array(["x", "y"], dtype=object)
+    b = np.array(["1", "2"], dtype=object)
+    hashes = validation._hash_keys([a, b])
+    assert hashes.dtype == np.int64 and len(hashes) == 2
+    assert hashes[0] != hashes[1]
+    assert (validation._hash_keys([a, b]) == hashes).all()
+    # Key parts are kept apart, ("x", "1") is not ("x1", "")
+    assert validation._hash_keys([np.array(["x1"], dtype=object),
+                                  np.array([""], dtype=object)])[0] != hashes[0]
+
+
+def make_archive(path, files):
+    with tarfile.open(path, "w:gz") as tar:
+        for name, text in files:
+            data = text.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+DATAPACKAGE = {"resources": [
+    {"name": "a", "path": "a.tsv",
+     "schema": {"fields": [{"name": "id"}], "primaryKey": "id"}},
+    {"name": "b", "path": "b.tsv",
+     "schema": {"fields": [{"name": "id", "type": "integer"}, {"name": "a"}],
+                "foreignKeys": [{"fields": "a", "reference": {"resource": "a", "fields": "id"}}]}}
+]}
+
+
+def validate(path):
+    with archives.open_archive(str(path)) as members:
+        validation.validate_datapackage(members)
+
+
+def test_validate_datapackage(tmp_path):
+    path = tmp_path / "valid.tgz"
+    # Tables stored before the datapackage and out of resource order
+    make_archive(path, [("b.tsv", "id\ta\n1\tx\n2\t\n"), ("a.tsv", "id\nx\ny\n"),
+                        ("datapackage.json", json.dumps(DATAPACKAGE))])
+    validate(path)
+
+
+def test_validate_datapackage_errors(tmp_path):
+    path = tmp_path / "invalid.tgz"
+    make_archive(path, [("datapackage.json", json.dumps(DATAPACKAGE)),
+                        ("a.tsv", "id\nx\nx\n"), ("b.tsv", "id\ta\none\tx\n2\tz\n")])
+    with pytest.raises(validation.ArchiveValidationError) as e:
+        validate(path)
+    assert e.value.errors == [
+        "a.tsv: 1 duplicate values of primary key ['id']",
+        "b.tsv: 1 values in 'id' that are not a valid integer (first at line 2)",
+        "b.tsv: 1 values of ['a'] not found in a ['id']",
+    ]